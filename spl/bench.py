@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+""" Benchmark spl commands against mock Sonos speakers. """
+
+from __future__ import print_function
+
+"""
+    Copyright 2015-2016 Jim Stuhlmacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os, sys, shutil, tempfile, time, json
+from xml.sax.saxutils import escape
+try:
+    from io import StringIO
+except ImportError:
+    # Python 2.7
+    from StringIO import StringIO
+
+import spl
+from mocksonos import MockHousehold
+
+
+def percentile(values, fraction):
+    """ Return the value at the fraction (0-1) of the sorted values. """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def writeXspf(fileName, title, household, tracks):
+    """ Write a playlist of synthetic tracks that spl can import. """
+    with open(fileName, 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fp.write('<playlist version="1" xmlns="http://xspf.org/ns/0/">\n')
+        fp.write('  <title>%s</title>\n' % escape(title))
+        fp.write('  <trackList>\n')
+        for number in range(tracks):
+            track = household.track(number)
+            fp.write('  <track>\n')
+            fp.write('    <location>%s</location>\n' % escape(track['uri']))
+            fp.write('  </track>\n')
+        fp.write('  </trackList>\n')
+        fp.write('</playlist>\n')
+
+
+class Bench:
+    """ Runs spl command lines in process and times them. """
+
+    def __init__(self, household, runs):
+        self.household = household
+        self.runs = runs
+        self.results = []
+
+    def runSpl(self, argv):
+        """ Run one spl command line.  Returns its exit code. """
+        output = StringIO()
+        oldStdout, oldStderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output
+        code = 0
+        try:
+            spl.SPL(argv)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            code = -1
+        finally:
+            sys.stdout, sys.stderr = oldStdout, oldStderr
+        if code:
+            lines = output.getvalue().strip().split('\n')
+            print('%s: exit %s: %s' % (' '.join(argv), code, lines[-1]),
+                  file=sys.stderr)
+        return code
+
+    def measure(self, name, argvs, tracks=0):
+        """ Time each command line of argvs.  tracks is the number of tracks
+            moved by one command. """
+        times = []
+        calls = 0
+        failed = 0
+        for argv in argvs:
+            self.household.stats(reset=True)
+            start = time.time()
+            if self.runSpl(argv):
+                failed += 1
+            times.append(time.time() - start)
+            calls += sum(self.household.stats().values())
+        result = {'name': name, 'runs': len(times), 'failed': failed,
+                  'p50': percentile(times, 0.5),
+                  'p99': percentile(times, 0.99),
+                  'callsPerOp': calls / float(len(times)),
+                  'tracksPerSec': (tracks * len(times) / sum(times)
+                                   if tracks and sum(times) else None)}
+        self.results.append(result)
+        return result
+
+    def report(self):
+        """ Print a table of the results. """
+        print('%-12s %5s %6s %9s %9s %9s %11s'
+              % ('operation', 'runs', 'failed', 'p50 ms', 'p99 ms',
+                 'calls/op', 'tracks/sec'))
+        for result in self.results:
+            rate = result['tracksPerSec']
+            print('%-12s %5d %6d %9.1f %9.1f %9.1f %11s'
+                  % (result['name'], result['runs'], result['failed'],
+                     result['p50'] * 1000, result['p99'] * 1000,
+                     result['callsPerOp'],
+                     '%.0f' % rate if rate is not None else '-'))
+
+
+def main():
+    """ Benchmark the common spl commands. """
+    parser = argparse.ArgumentParser(description='''
+Benchmark spl against mock Sonos speakers at 127.0.0.2 and up.  Reports the
+p50 and p99 command latency, the SOAP calls per command and the tracks per
+second of export and import.
+''')
+    parser.add_argument('-n', '--speakers', type=int, default=3,
+                        help='Number of speakers.  Default is 3.')
+    parser.add_argument('-P', '--playlists', type=int, default=4,
+                        help='Number of saved playlists.  Default is 4.')
+    parser.add_argument('-t', '--tracks', type=int, default=5000,
+                        help='Tracks per playlist (up to 50000).  Default'
+                        ' is 5000.')
+    parser.add_argument('-r', '--runs', type=int, default=10,
+                        help='Runs of each command.  Default is 10.')
+    parser.add_argument('-l', '--latency', type=float, default=5,
+                        help='Milliseconds added to each call.  Default'
+                        ' is 5.')
+    parser.add_argument('-j', '--jitter', type=float, default=2,
+                        help='Random +/- milliseconds added to each call.'
+                        '  Default is 2.')
+    parser.add_argument('-f', '--failRate', type=float, default=0,
+                        help='Fraction of calls that fail (0-1).')
+    parser.add_argument('-d', '--discovery', action='store_true',
+                        help='Also benchmark SSDP discovery.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    tracks = min(args.tracks, 50000)
+    household = MockHousehold(['127.0.0.%d' % (idx + 2)
+                               for idx in range(args.speakers)],
+                              args.latency / 1000.0, args.jitter / 1000.0,
+                              args.failRate)
+    for idx in range(args.playlists):
+        household.addPlaylist('Playlist %d' % (idx + 1), tracks, idx * tracks)
+    household.addLibrary(tracks)
+    household.start(args.discovery)
+
+    # keep the zone cache and exported files out of the user's home
+    workDir = tempfile.mkdtemp(prefix='spl-bench-')
+    oldCwd = os.getcwd()
+    os.chdir(workDir)
+    spl.CACHE_DIR = os.path.join(workDir, 'cache')
+    ip = household.speakers[0].ip
+    runs = range(args.runs)
+    bench = Bench(household, args.runs)
+    try:
+        bench.measure('list', [['-s', ip, '-l'] for run in runs])
+        bench.measure('status', [['-s', ip, '-S'] for run in runs])
+        bench.measure('volume', [['-s', ip, '-v', '+1'] for run in runs])
+        bench.measure('toggle', [['-s', ip, '-t'] for run in runs])
+        bench.measure('queue', [['-s', ip, '-q', 'Playlist 1']
+                                for run in runs])
+        if args.speakers > 1:
+            bench.measure('party on', [['-s', ip, '-P']])
+            bench.measure('group vol', [['-s', ip, '-v', '+1']
+                                        for run in runs])
+            bench.measure('party off', [['-s', ip, '-p']])
+            bench.measure('all pause', [['--allCoordinators', '--pause']
+                                        for run in runs])
+        bench.measure('index lib', [['-s', ip, '--indexLibrary', '-j', '4']],
+                      tracks)
+        bench.measure('query', [['-s', ip, '-q', 'genre:"Genre 1"']
+                                for run in runs])
+        bench.measure('export', [['-s', ip, '-x', 'Playlist 1', '-f']
+                                 for run in runs], tracks)
+        bench.measure('export all', [['-s', ip, '-X', '-f', '-j', '4']
+                                     for run in runs],
+                      tracks * args.playlists)
+        importTracks = min(tracks, 1000)
+        for run in runs:
+            writeXspf('import%d.xspf' % run, 'Bench %d' % run, household,
+                      importTracks)
+        bench.measure('import', [['-s', ip, '-i', 'import%d.xspf' % run]
+                                 for run in runs], importTracks)
+        if args.discovery:
+            bench.measure('discovery', [['-T', '0', '-l'] for run in runs])
+    finally:
+        household.stop()
+        os.chdir(oldCwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(bench.results, indent=2))
+    else:
+        bench.report()
+
+if __name__ == "__main__":
+    main()
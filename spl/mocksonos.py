@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+
+""" Mock Sonos speakers for measuring spl without real hardware. """
+
+from __future__ import print_function
+
+"""
+    Copyright 2015-2016 Jim Stuhlmacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import random, socket, struct, sys, threading, time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import quote, unquote
+except ImportError:
+    # Python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote, unquote
+
+PORT = 1400     # soco always uses this port
+DIDL_START = ('<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/"'
+              ' xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/"'
+              ' xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/"'
+              ' xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">')
+DIDL_END = '</DIDL-Lite>'
+PLAYLIST_URI = 'file:///jffs/settings/savedqueues.rsq#'
+END_OF_PLAYLIST = 4294967295
+SSDP_GROUP = '239.255.255.250'
+SSDP_PORT = 1900
+
+
+class UPnPError(Exception):
+    """ A UPnP fault returned to the caller. """
+
+    def __init__(self, code):
+        Exception.__init__(self, 'UPnP error %d' % code)
+        self.code = code
+
+
+class MockSpeaker:
+    """ State of one speaker. """
+
+    def __init__(self, number, ip):
+        self.ip = ip
+        self.uid = 'RINCON_MOCK%07d01400' % number
+        self.name = 'Mock %d' % number
+        self.coordinator = self
+        self.state = 'STOPPED'
+        self.playMode = 'NORMAL'
+        self.crossFade = False
+        self.volume = 20
+        self.snapshot = None    # member volumes for SetGroupVolume
+        self.queue = []
+        self.track = 0
+        self.lock = threading.Lock()
+
+
+class MockHousehold:
+    """ Speakers sharing the saved playlists and the music library, with
+        per call latency, jitter and failure injection.  Every call is
+        counted by action name. """
+
+    def __init__(self, ips, latency=0.0, jitter=0.0, failRate=0.0,
+                 pageLimit=1000, first=1):
+        # first numbers the speakers, households in one process need
+        # distinct numbers
+        self.speakers = [MockSpeaker(number + first, ip)
+                         for number, ip in enumerate(ips)]
+        self.latency = latency
+        self.jitter = jitter
+        self.failRate = failRate
+        self.pageLimit = pageLimit
+        self.groupRendering = True  # False for speakers without group volume
+        self.playlists = {}     # number -> {'title', 'tracks', 'updateId'}
+        self.library = []
+        self.updateId = 1       # of the saved playlist container
+        self.systemUpdateId = 1
+        self.libraryUpdateId = 1
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.servers = []
+
+    def track(self, number):
+        """ Return a synthetic track. """
+        artist = 'Artist %d' % (number % 97)
+        album = 'Album %d' % (number % 389)
+        title = 'Track %d' % number
+        uri = 'x-file-cifs://nas/music/%s/%s/%s.mp3' % (
+            quote(artist), quote(album), quote(title))
+        return {'uri': uri, 'title': title, 'creator': artist,
+                'album': album, 'genre': 'Genre %d' % (number % 11)}
+
+    def addPlaylist(self, title, tracks, first=0):
+        """ Add a saved playlist of synthetic tracks.  Returns its number. """
+        with self.lock:
+            number = max([0] + list(self.playlists)) + 1
+            self.playlists[number] = {
+                'title': title, 'updateId': 1,
+                'tracks': [self.track(first + idx) for idx in range(tracks)]}
+            self.changed()
+        return number
+
+    def addLibrary(self, tracks):
+        """ Fill the music library with synthetic tracks. """
+        self.library = [self.track(idx) for idx in range(tracks)]
+        self.systemUpdateId += 1
+        self.libraryUpdateId += 1
+
+    def changed(self, playlist=None):
+        """ Note a change of the saved playlists. """
+        self.updateId += 1
+        self.systemUpdateId += 1
+        if playlist is not None:
+            playlist['updateId'] += 1
+
+    def stats(self, reset=False):
+        """ Return the number of calls by action. """
+        with self.lock:
+            calls = dict(self.calls)
+            if reset:
+                self.calls = {}
+        return calls
+
+    def start(self, ssdp=False):
+        """ Serve every speaker on port 1400 of its address, in background
+            threads.  With ssdp the speakers also answer discovery. """
+        for speaker in self.speakers:
+            server = MockServer((speaker.ip, PORT), MockHandler)
+            server.household = self
+            server.speaker = speaker
+            server.connections = set()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+        if ssdp:
+            thread = threading.Thread(target=self.answerDiscovery)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ Stop serving. """
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.closeConnections()
+        self.servers = []
+
+    def answerDiscovery(self):
+        """ Answer SSDP searches for zone players. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', SSDP_PORT))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack('4sl', socket.inet_aton(SSDP_GROUP),
+                                    socket.INADDR_ANY))
+        while True:
+            data, addr = sock.recvfrom(1024)
+            if b'ZonePlayer' not in data:
+                continue
+            speaker = self.speakers[0]
+            reply = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            reply.bind((speaker.ip, 0))
+            reply.sendto(('HTTP/1.1 200 OK\r\n'
+                          'LOCATION: http://%s:%d/xml/device_description.xml'
+                          '\r\nSERVER: Linux UPnP/1.0 Sonos/99.9 (MOCK)\r\n'
+                          'ST: urn:schemas-upnp-org:device:ZonePlayer:1\r\n'
+                          'X-RINCON-HOUSEHOLD: Sonos_%s\r\n'
+                          '\r\n' % (speaker.ip, PORT, speaker.uid)
+                          ).encode('utf-8'), addr)
+            reply.close()
+
+    def call(self, speaker, action, args):
+        """ Run an action for the speaker.  Returns the output arguments as
+            a list of (name, value). """
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.failRate and random.random() < self.failRate:
+            raise UPnPError(501)
+        method = getattr(self, 'do' + action, None)
+        if method is None:
+            raise UPnPError(401)
+        with self.lock:
+            return method(speaker, args) or []
+
+    # ZoneGroupTopology
+
+    def doGetZoneGroupState(self, speaker, args):
+        groups = []
+        for coordinator in self.speakers:
+            if coordinator.coordinator != coordinator:
+                continue
+            members = ''.join([
+                '<ZoneGroupMember UUID="%s" ZoneName="%s"'
+                ' Location="http://%s:%d/xml/device_description.xml"/>' %
+                (member.uid, member.name, member.ip, PORT)
+                for member in self.speakers
+                if member.coordinator == coordinator])
+            groups.append('<ZoneGroup Coordinator="%s" ID="%s:1">%s'
+                          '</ZoneGroup>' % (coordinator.uid, coordinator.uid,
+                                            members))
+        return [('ZoneGroupState', '<ZoneGroupState><ZoneGroups>%s'
+                 '</ZoneGroups></ZoneGroupState>' % ''.join(groups))]
+
+    # ContentDirectory
+
+    def doBrowse(self, speaker, args):
+        objectId = args['ObjectID']
+        start = int(args['StartingIndex'])
+        count = min(int(args['RequestedCount']) or self.pageLimit,
+                    self.pageLimit)
+        if objectId == 'Q:0' and args['BrowseFlag'] == 'BrowseMetadata':
+            result = ('<container id="Q:0" parentID="Q:" restricted="true"'
+                      ' childCount="%d"><dc:title>Queue</dc:title>'
+                      '<upnp:class>object.container.playlistContainer'
+                      '</upnp:class></container>' % len(speaker.queue))
+            return self.browseResult(result, 1, 1, 1)
+        if objectId == 'SQ:':
+            numbers = sorted(self.playlists)[start:start + count]
+            result = ''.join([self.playlistDidl(number)
+                              for number in numbers])
+            return self.browseResult(result, len(numbers),
+                                     len(self.playlists), self.updateId)
+        if objectId == 'Q:0':
+            tracks = speaker.coordinator.queue
+            updateId = 1
+        elif objectId.startswith('SQ:'):
+            playlist = self.playlists.get(self.playlistNumber(objectId))
+            if playlist is None:
+                raise UPnPError(701)
+            tracks = playlist['tracks']
+            updateId = playlist['updateId']
+        elif objectId == 'A:TRACKS':
+            tracks = self.library
+            updateId = self.libraryUpdateId
+        elif objectId == 'A:GENRE':
+            genres = sorted(set([track['genre'] for track in self.library]))
+            result = ''.join([self.genreDidl(genre)
+                              for genre in genres[start:start + count]])
+            return self.browseResult(result, len(genres[start:start + count]),
+                                     len(genres), self.libraryUpdateId)
+        elif objectId.startswith('A:GENRE/') and objectId.endswith('//'):
+            # all the tracks of the genre
+            genre = unquote(objectId[len('A:GENRE/'):-2])
+            tracks = [track for track in self.library
+                      if track['genre'] == genre]
+            updateId = self.libraryUpdateId
+        else:
+            raise UPnPError(701)
+        page = tracks[start:start + count]
+        result = ''.join([self.trackDidl(track, '%s/%d' % (objectId, idx),
+                                         objectId)
+                          for idx, track in enumerate(page, start + 1)])
+        return self.browseResult(result, len(page), len(tracks), updateId)
+
+    def doGetSystemUpdateID(self, speaker, args):
+        return [('Id', self.systemUpdateId)]
+
+    def doDestroyObject(self, speaker, args):
+        if self.playlists.pop(self.playlistNumber(args['ObjectID']),
+                              None) is None:
+            raise UPnPError(701)
+        self.changed()
+
+    # AVTransport
+
+    def doGetTransportInfo(self, speaker, args):
+        return [('CurrentTransportState', speaker.coordinator.state),
+                ('CurrentTransportStatus', 'OK'), ('CurrentSpeed', '1')]
+
+    def doPlay(self, speaker, args):
+        speaker.coordinator.state = 'PLAYING'
+
+    def doPause(self, speaker, args):
+        speaker.coordinator.state = 'PAUSED_PLAYBACK'
+
+    def doStop(self, speaker, args):
+        speaker.coordinator.state = 'STOPPED'
+
+    def doGetTransportSettings(self, speaker, args):
+        return [('PlayMode', speaker.coordinator.playMode),
+                ('RecQualityMode', 'NOT_IMPLEMENTED')]
+
+    def doSetPlayMode(self, speaker, args):
+        speaker.coordinator.playMode = args['NewPlayMode']
+
+    def doGetCrossfadeMode(self, speaker, args):
+        return [('CrossfadeMode', int(speaker.coordinator.crossFade))]
+
+    def doSetCrossfadeMode(self, speaker, args):
+        speaker.coordinator.crossFade = args['CrossfadeMode'] == '1'
+
+    def doGetPositionInfo(self, speaker, args):
+        queue = speaker.coordinator.queue
+        if not queue:
+            return [('Track', 0), ('TrackDuration', '0:00:00'),
+                    ('TrackURI', ''), ('TrackMetaData', ''),
+                    ('RelTime', '0:00:00')]
+        track = queue[min(speaker.coordinator.track, len(queue) - 1)]
+        return [('Track', speaker.coordinator.track + 1),
+                ('TrackDuration', '0:03:00'), ('TrackURI', track['uri']),
+                ('TrackMetaData',
+                 DIDL_START + self.trackDidl(track, '-1', '-1') + DIDL_END),
+                ('RelTime', '0:00:00')]
+
+    def doGetMediaInfo(self, speaker, args):
+        return [('NrTracks', len(speaker.coordinator.queue)),
+                ('CurrentURI', 'x-rincon-queue:%s#0' % speaker.uid),
+                ('CurrentURIMetaData', '')]
+
+    def doRemoveAllTracksFromQueue(self, speaker, args):
+        speaker.queue = []
+
+    def doAddURIToQueue(self, speaker, args):
+        tracks = self.resolve(args['EnqueuedURI'],
+                              args.get('EnqueuedURIMetaData', ''))
+        first = len(speaker.queue) + 1
+        speaker.queue.extend(tracks)
+        return [('FirstTrackNumberEnqueued', first),
+                ('NumTracksAdded', len(tracks)),
+                ('NewQueueLength', len(speaker.queue))]
+
+    def doAddMultipleURIsToQueue(self, speaker, args):
+        uris = args['EnqueuedURIs'].split(' ')
+        metadata = [meta + DIDL_END for meta in
+                    args['EnqueuedURIsMetaData'].split(DIDL_END)[:-1]]
+        # Sonos accepts at most 16 URIs per call
+        if int(args['NumberOfURIs']) != len(uris) or len(uris) > 16:
+            raise UPnPError(402)
+        metadata += [''] * (len(uris) - len(metadata))
+        first = len(speaker.queue) + 1
+        for uri, meta in zip(uris, metadata):
+            speaker.queue.extend(self.resolve(uri, meta))
+        return [('FirstTrackNumberEnqueued', first),
+                ('NumTracksAdded', len(speaker.queue) - first + 1),
+                ('NewQueueLength', len(speaker.queue)),
+                ('NewUpdateID', 1)]
+
+    def doSaveQueue(self, speaker, args):
+        number = max([0] + list(self.playlists)) + 1
+        self.playlists[number] = {'title': args['Title'], 'updateId': 1,
+                                  'tracks': list(speaker.queue)}
+        self.changed()
+        return [('AssignedObjectID', 'SQ:%d' % number)]
+
+    def doReorderTracksInSavedQueue(self, speaker, args):
+        playlist = self.savedPlaylist(args)
+        tracks = playlist['tracks']
+        before = len(tracks)
+        trackList = [int(idx) for idx in args['TrackList'].split(',')]
+        positions = args['NewPositionList'].split(',')
+        if positions == ['']:
+            # remove the tracks
+            for idx in sorted(trackList, reverse=True):
+                if idx >= len(tracks):
+                    raise UPnPError(402)
+                del tracks[idx]
+        else:
+            for idx, position in zip(trackList, positions):
+                if idx >= len(tracks):
+                    raise UPnPError(402)
+                tracks.insert(int(position), tracks.pop(idx))
+        self.changed(playlist)
+        return [('QueueLengthChange', len(tracks) - before),
+                ('NewQueueLength', len(tracks)),
+                ('NewUpdateID', playlist['updateId'])]
+
+    def doAddURIToSavedQueue(self, speaker, args):
+        playlist = self.savedPlaylist(args)
+        tracks = self.resolve(args['EnqueuedURI'],
+                              args.get('EnqueuedURIMetaData', ''))
+        index = int(args['AddAtIndex'])
+        if index >= END_OF_PLAYLIST or index > len(playlist['tracks']):
+            index = len(playlist['tracks'])
+        playlist['tracks'][index:index] = tracks
+        self.changed(playlist)
+        return [('FirstTrackNumberEnqueued', index + 1),
+                ('NumTracksAdded', len(tracks)),
+                ('NewQueueLength', len(playlist['tracks'])),
+                ('NewUpdateID', playlist['updateId'])]
+
+    def doSetAVTransportURI(self, speaker, args):
+        uri = args['CurrentURI']
+        if uri.startswith('x-rincon:'):
+            for coordinator in self.speakers:
+                if coordinator.uid == uri[len('x-rincon:'):]:
+                    for member in self.speakers:
+                        if member.coordinator == speaker:
+                            member.coordinator = coordinator
+                    speaker.coordinator = coordinator
+                    return
+            raise UPnPError(402)
+
+    def doSeek(self, speaker, args):
+        if args['Unit'] == 'TRACK_NR':
+            speaker.coordinator.track = int(args['Target']) - 1
+
+    def doBecomeCoordinatorOfStandaloneGroup(self, speaker, args):
+        speaker.coordinator = speaker
+
+    # RenderingControl
+
+    def doGetVolume(self, speaker, args):
+        return [('CurrentVolume', speaker.volume)]
+
+    def doSetVolume(self, speaker, args):
+        speaker.volume = max(0, min(100, int(args['DesiredVolume'])))
+
+    def doSetRelativeVolume(self, speaker, args):
+        speaker.volume = max(0, min(100, speaker.volume +
+                                    int(args['Adjustment'])))
+        return [('NewVolume', speaker.volume)]
+
+    # GroupRenderingControl
+
+    def groupMembers(self, speaker):
+        if not self.groupRendering:
+            raise UPnPError(401)
+        if speaker.coordinator != speaker:
+            raise UPnPError(701)
+        return [member for member in self.speakers
+                if member.coordinator == speaker]
+
+    def scaleGroup(self, speaker, volumes, desired):
+        average = float(sum(volumes.values())) / len(volumes)
+        for member, volume in volumes.items():
+            if average:
+                volume = int(round(volume * desired / average))
+            else:
+                volume = desired
+            member.volume = max(0, min(100, volume))
+
+    def doGetGroupVolume(self, speaker, args):
+        members = self.groupMembers(speaker)
+        return [('CurrentVolume', sum([member.volume for member in members])
+                 // len(members))]
+
+    def doSnapshotGroupVolume(self, speaker, args):
+        speaker.snapshot = dict([(member, member.volume)
+                                 for member in self.groupMembers(speaker)])
+
+    def doSetGroupVolume(self, speaker, args):
+        members = self.groupMembers(speaker)
+        volumes = speaker.snapshot or dict([(member, member.volume)
+                                            for member in members])
+        self.scaleGroup(speaker, volumes,
+                        max(0, min(100, int(args['DesiredVolume']))))
+
+    def doSetRelativeGroupVolume(self, speaker, args):
+        members = self.groupMembers(speaker)
+        volumes = dict([(member, member.volume) for member in members])
+        average = sum(volumes.values()) // len(volumes)
+        desired = max(0, min(100, average + int(args['Adjustment'])))
+        self.scaleGroup(speaker, volumes, desired)
+        return [('NewVolume', desired)]
+
+    # helpers
+
+    def browseResult(self, result, returned, total, updateId):
+        return [('Result', DIDL_START + result + DIDL_END),
+                ('NumberReturned', returned), ('TotalMatches', total),
+                ('UpdateID', updateId)]
+
+    def playlistNumber(self, objectId):
+        try:
+            return int(objectId.split(':', 1)[1])
+        except ValueError:
+            raise UPnPError(701)
+
+    def savedPlaylist(self, args):
+        playlist = self.playlists.get(self.playlistNumber(args['ObjectID']))
+        if playlist is None:
+            raise UPnPError(701)
+        if int(args['UpdateID']) not in (0, playlist['updateId']):
+            # the playlist changed since the caller read it
+            raise UPnPError(412)
+        return playlist
+
+    def playlistDidl(self, number):
+        return ('<container id="SQ:%d" parentID="SQ:" restricted="true">'
+                '<dc:title>%s</dc:title>'
+                '<upnp:class>object.container.playlistContainer</upnp:class>'
+                '<res protocolInfo="file:*:audio/mpegurl:*">%s%d</res>'
+                '</container>' % (number,
+                                  escape(self.playlists[number]['title']),
+                                  PLAYLIST_URI, number))
+
+    def genreDidl(self, genre):
+        return ('<container id="A:GENRE/%s" parentID="A:GENRE"'
+                ' restricted="true"><dc:title>%s</dc:title>'
+                '<upnp:class>object.container.genre.musicGenre</upnp:class>'
+                '</container>' % (escape(quote(genre)), escape(genre)))
+
+    def trackDidl(self, track, itemId, parentId):
+        return ('<item id="%s" parentID="%s" restricted="true">'
+                '<res protocolInfo="x-file-cifs:*:audio/mpeg:*">%s</res>'
+                '<dc:title>%s</dc:title>'
+                '<upnp:class>object.item.audioItem.musicTrack</upnp:class>'
+                '<dc:creator>%s</dc:creator><upnp:album>%s</upnp:album>'
+                '</item>' % (escape(itemId), escape(parentId),
+                             escape(track['uri']), escape(track['title']),
+                             escape(track['creator']), escape(track['album'])))
+
+    def resolve(self, uri, metadata):
+        """ Return the tracks a URI adds: a saved playlist expands to its
+            tracks, anything else is one track described by the metadata. """
+        if uri.startswith(PLAYLIST_URI):
+            playlist = self.playlists.get(int(uri[len(PLAYLIST_URI):]))
+            if playlist is None:
+                raise UPnPError(701)
+            return list(playlist['tracks'])
+        track = {'uri': uri, 'title': uri.rsplit('/', 1)[-1], 'creator': '',
+                 'album': ''}
+        if metadata:
+            try:
+                didl = ET.fromstring(metadata.encode('utf-8'))
+            except ET.ParseError:
+                raise UPnPError(402)
+            for key, tag in (('title', 'dc:title'), ('creator', 'dc:creator'),
+                             ('album', 'upnp:album')):
+                ns, name = tag.split(':')
+                text = didl.findtext('.//{%s}%s' % (
+                    {'dc': 'http://purl.org/dc/elements/1.1/',
+                     'upnp': 'urn:schemas-upnp-org:metadata-1-0/upnp/'}[ns],
+                    name))
+                if text:
+                    track[key] = text
+        return [track]
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server of one mock speaker. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def closeConnections(self):
+        """ Hang up the kept alive connections, so clients reconnect to
+            whatever serves the address next. """
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before the reply
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Answers the SOAP calls and the device description of a speaker. """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        speaker = self.server.speaker
+        if self.path == '/xml/ZoneGroupTopology1.xml':
+            # soco reads the signature of actions called without arguments
+            self.reply(200, '<?xml version="1.0"?>'
+                       '<scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+                       '<serviceStateTable><stateVariable><name>ZoneGroupState'
+                       '</name><dataType>string</dataType></stateVariable>'
+                       '</serviceStateTable><actionList><action><name>'
+                       'GetZoneGroupState</name><argumentList><argument>'
+                       '<name>ZoneGroupState</name><direction>out</direction>'
+                       '<relatedStateVariable>ZoneGroupState'
+                       '</relatedStateVariable></argument></argumentList>'
+                       '</action></actionList></scpd>')
+            return
+        if self.path != '/xml/device_description.xml':
+            self.reply(404, '')
+            return
+        self.reply(200, '<?xml version="1.0"?>'
+                   '<root xmlns="urn:schemas-upnp-org:device-1-0"><device>'
+                   '<roomName>%s</roomName><serialNum>00-00-00-00-00-00:0'
+                   '</serialNum><modelName>Mock</modelName><modelNumber>M1'
+                   '</modelNumber><softwareVersion>99.9</softwareVersion>'
+                   '</device></root>' % escape(speaker.name))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        soapAction = self.headers.get('SOAPACTION', '').strip('"')
+        service, action = soapAction.rsplit('#', 1)
+        args = {}
+        for call in ET.fromstring(body).find(
+                '{http://schemas.xmlsoap.org/soap/envelope/}Body'):
+            for arg in call:
+                args[arg.tag] = arg.text or ''
+        try:
+            result = self.server.household.call(self.server.speaker, action,
+                                                args)
+        except UPnPError as e:
+            self.reply(500, '<?xml version="1.0"?><s:Envelope xmlns:s='
+                       '"http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+                       '<s:Fault><faultcode>s:Client</faultcode><faultstring>'
+                       'UPnPError</faultstring><detail><UPnPError xmlns='
+                       '"urn:schemas-upnp-org:control-1-0"><errorCode>%d'
+                       '</errorCode></UPnPError></detail></s:Fault></s:Body>'
+                       '</s:Envelope>' % e.code)
+            return
+        values = ''.join(['<%s>%s</%s>' % (name, escape(str(value)), name)
+                          for name, value in result])
+        self.reply(200, '<?xml version="1.0"?><s:Envelope xmlns:s='
+                   '"http://schemas.xmlsoap.org/soap/envelope/" s:encoding'
+                   'Style="http://schemas.xmlsoap.org/soap/encoding/">'
+                   '<s:Body><u:%sResponse xmlns:u="%s">%s</u:%sResponse>'
+                   '</s:Body></s:Envelope>' % (action, service, values,
+                                               action))
+
+    def reply(self, status, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    """ Serve mock speakers until interrupted. """
+    parser = argparse.ArgumentParser(description='''
+Mock Sonos speakers for spl.  Each speaker listens on port 1400 of its own
+loopback address, starting at 127.0.0.2.
+''')
+    parser.add_argument('-n', '--speakers', type=int, default=1,
+                        help='Number of speakers.  Default is 1.')
+    parser.add_argument('-P', '--playlists', type=int, default=3,
+                        help='Number of saved playlists.  Default is 3.')
+    parser.add_argument('-t', '--tracks', type=int, default=1000,
+                        help='Tracks per playlist (up to 50000).  Default'
+                        ' is 1000.')
+    parser.add_argument('-L', '--library', type=int, default=0,
+                        help='Tracks in the music library.  Default is 0.')
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help='Milliseconds added to each call.')
+    parser.add_argument('-j', '--jitter', type=float, default=0,
+                        help='Random +/- milliseconds added to each call.')
+    parser.add_argument('-f', '--failRate', type=float, default=0,
+                        help='Fraction of calls that fail (0-1).')
+    parser.add_argument('-p', '--pageLimit', type=int, default=1000,
+                        help='Most items returned by one browse.  Default'
+                        ' is 1000.')
+    parser.add_argument('-d', '--discovery', action='store_true',
+                        help='Answer SSDP discovery.')
+    args = parser.parse_args()
+
+    household = MockHousehold(['127.0.0.%d' % (idx + 2)
+                               for idx in range(args.speakers)],
+                              args.latency / 1000.0, args.jitter / 1000.0,
+                              args.failRate, args.pageLimit)
+    for idx in range(args.playlists):
+        household.addPlaylist('Playlist %d' % (idx + 1),
+                              min(args.tracks, 50000), idx * args.tracks)
+    household.addLibrary(args.library)
+    household.start(args.discovery)
+    for speaker in household.speakers:
+        print('%s at %s' % (speaker.name, speaker.ip))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        household.stop()
+
+if __name__ == "__main__":
+    main()
@@ -22,9 +22,8 @@ from __future__ import print_function
 """
 
 import argparse
-import os, sys, random
+import os, sys, random, time, json, bisect
 import xml.etree.ElementTree as ET
-import soco
 try:
     import html
     def unescape(s):
@@ -38,10 +37,609 @@ except ImportError:
         # this has to be last:
         s = s.replace("&amp;", "&")
         return s
-import codecs
+try:
+    import queue
+    import socketserver
+    from io import StringIO
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+    import SocketServer as socketserver
+    from StringIO import StringIO
+import fnmatch
+import gzip
+import shlex
+import socket
+import sqlite3
+import threading
 import traceback
 from pprint import pprint
 
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.spl')
+MAX_JOBS = 8
+# browse page size limits and the target response time in seconds
+PAGE_MIN = 100
+PAGE_MAX = 1000
+PAGE_TARGET = 0.5
+# most URIs a speaker takes in one AddMultipleURIsToQueue call
+MAX_URIS = 16
+MANIFEST = '.spl_manifest.json'
+CHECKPOINT = 'import.json'
+PLAYLIST_INDEX = 'playlists.json'
+ARCHIVE_SCHEMA = '''
+PRAGMA auto_vacuum = FULL;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    creator TEXT,
+    title TEXT,
+    album TEXT,
+    didl TEXT);
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL UNIQUE,
+    itemId TEXT,
+    updateId INTEGER,
+    tracks INTEGER,
+    time REAL);
+CREATE TABLE IF NOT EXISTS entries (
+    playlist INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    track INTEGER NOT NULL,
+    PRIMARY KEY (playlist, position)) WITHOUT ROWID;
+'''
+LIBRARY_INDEX = 'library.db'
+LIBRARY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+CREATE TABLE IF NOT EXISTS tracks (
+    uri TEXT PRIMARY KEY,
+    artist TEXT COLLATE NOCASE,
+    album TEXT COLLATE NOCASE,
+    title TEXT COLLATE NOCASE,
+    genre TEXT COLLATE NOCASE,
+    track INTEGER,
+    didl TEXT);
+CREATE INDEX IF NOT EXISTS tracksArtist ON tracks (artist, album, track);
+CREATE INDEX IF NOT EXISTS tracksAlbum ON tracks (album);
+CREATE INDEX IF NOT EXISTS tracksGenre ON tracks (genre);
+'''
+# fields of the library index that -q queries can match
+QUERY_FIELDS = ('artist', 'album', 'title', 'genre')
+# application of the XSPF extension holding the DIDL-Lite of a track
+DIDL_APPLICATION = 'https://github.com/stu247/spl/didl'
+# bytes buffered when writing an export file
+WRITE_BUFFER = 1 << 16
+# upper bounds in milliseconds of the buckets of the latency histograms
+HISTOGRAM = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# phase of the calls to each speaker service
+PHASES = {'AVTransport': 'transport', 'RenderingControl': 'volume',
+          'GroupRenderingControl': 'volume', 'ContentDirectory': 'library',
+          'ZoneGroupTopology': 'topology'}
+# seconds to connect to a speaker, and to wait for the answer by phase
+CONNECT_TIMEOUT = 2
+CALL_TIMEOUT = 5
+CALL_TIMEOUTS = {'browse': 20, 'library': 20, 'queue': 60}
+# retries of reads, after about RETRY_DELAY, twice that, ... seconds
+RETRIES = 2
+RETRY_DELAY = 0.1
+# services whose reads a group coordinator answers for its members
+REROUTE = ('AVTransport', 'ContentDirectory', 'ZoneGroupTopology')
+# seconds calls to a speaker that did not answer fail without trying
+UNREACHABLE_TTL = 30
+# soco is imported by SPL so that --client does not pay for it
+soco = None
+
+
+class Metrics(object):
+    """ Latency, size and outcome of the calls to the speakers, discovery
+        and export file writes, by phase, action and speaker.  Every record
+        is also passed to the functions in hooks, so a program embedding spl
+        can collect them. """
+
+    def __init__(self):
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget the recorded calls. """
+        with self.lock:
+            self.calls = {}
+
+    def record(self, phase, action, target, seconds, size, outcome):
+        """ Record one call.  size is the bytes sent and received, outcome
+            is 'ok' or a short description of the failure. """
+        with self.lock:
+            calls = self.calls.setdefault((phase, action, target),
+                                          {'seconds': [], 'errors': 0,
+                                           'bytes': 0})
+            calls['seconds'].append(seconds)
+            calls['bytes'] += size
+            if outcome != 'ok':
+                calls['errors'] += 1
+        if self.hooks:
+            record = {'phase': phase, 'action': action, 'target': target,
+                      'seconds': seconds, 'bytes': size, 'outcome': outcome,
+                      'time': time.time()}
+            for hook in list(self.hooks):
+                try:
+                    hook(record)
+                except Exception:
+                    # a broken hook must not fail the call
+                    traceback.print_exc()
+
+    def summary(self):
+        """ Return the calls, errors, bytes, total seconds, latency
+            percentiles and histogram by phase, by phase and action and by
+            speaker. """
+        with self.lock:
+            calls = dict((key, dict(value, seconds=list(value['seconds'])))
+                         for key, value in self.calls.items())
+        summary = {'histogramMs': HISTOGRAM}
+        for name, group in (('phases', lambda key: key[0]),
+                            ('actions', lambda key: key[0] + ' ' + key[1]),
+                            ('speakers', lambda key: key[2])):
+            totals = {}
+            for key, value in calls.items():
+                total = totals.setdefault(group(key), {'seconds': [],
+                                                       'errors': 0,
+                                                       'bytes': 0})
+                total['seconds'] += value['seconds']
+                total['errors'] += value['errors']
+                total['bytes'] += value['bytes']
+            summary[name] = {}
+            for key, total in totals.items():
+                seconds = sorted(total['seconds'])
+                histogram = [0] * (len(HISTOGRAM) + 1)
+                for value in seconds:
+                    histogram[bisect.bisect_left(HISTOGRAM,
+                                                 value * 1000)] += 1
+                summary[name][key] = {
+                    'calls': len(seconds), 'errors': total['errors'],
+                    'bytes': total['bytes'], 'seconds': sum(seconds),
+                    'p50Ms': seconds[len(seconds) // 2] * 1000,
+                    'p99Ms': seconds[min(len(seconds) - 1,
+                                         int(0.99 * len(seconds)))] * 1000,
+                    'maxMs': seconds[-1] * 1000,
+                    'histogram': histogram}
+        return summary
+
+    def report(self):
+        """ Print the summary as tables, with the latency histogram of each
+            phase. """
+        summary = self.summary()
+        for name in ('phases', 'actions', 'speakers'):
+            if not summary[name]:
+                continue
+            print('%-22s %5s %5s %8s %7s %7s %7s %8s'
+                  % (name[:-1], 'calls', 'errs', 'total s', 'p50 ms',
+                     'p99 ms', 'max ms', 'KiB'))
+            for key in sorted(summary[name]):
+                total = summary[name][key]
+                print('%-22s %5d %5d %8.3f %7.1f %7.1f %7.1f %8.1f'
+                      % (key[:22], total['calls'], total['errors'],
+                         total['seconds'], total['p50Ms'], total['p99Ms'],
+                         total['maxMs'], total['bytes'] / 1024.0))
+                if name == 'phases':
+                    labels = ['<=%d' % bound for bound in HISTOGRAM] + \
+                             ['>%d' % HISTOGRAM[-1]]
+                    print('    ms ' + '  '.join(
+                          '%s:%d' % (label, count) for label, count in
+                          zip(labels, total['histogram']) if count))
+            print('')
+
+    def save(self, fileName):
+        """ Write the summary as JSON to the file, or standard output for
+            '-'. """
+        text = json.dumps(self.summary(), indent=1, sort_keys=True)
+        if fileName == '-':
+            print(text)
+            return
+        try:
+            with open(fileName, 'w') as fp:
+                fp.write(text + '\n')
+        except IOError as e:
+            print("Error: file {0}: {1}".format(fileName, e.strerror))
+
+
+metrics = Metrics()
+
+
+class SoapTransport(object):
+    """ Stands in for the requests module used by soco so each thread sends
+        its SOAP calls over its own keep-alive HTTP session.  Every call is
+        recorded in metrics.  Calls time out, reads are retried, on the
+        group coordinator when it is known, and a speaker that does not
+        answer is skipped for UNREACHABLE_TTL seconds. """
+
+    def __init__(self, requests):
+        self.requests = requests
+        self.local = threading.local()
+        self.timeout = None         # seconds, None for CALL_TIMEOUTS
+        self.retries = RETRIES
+        self.coordinators = {}      # IP address -> of its coordinator
+        self.unreachable = {}       # IP address -> until time
+        self.idle = []              # sessions released by their threads
+        self.lock = threading.Lock()
+
+    def configure(self, timeout, retries):
+        """ Set the call timeout (None for the default of each phase) and
+            the retries of reads. """
+        self.timeout = timeout
+        self.retries = max(0, retries)
+
+    def __getattr__(self, name):
+        return getattr(self.requests, name)
+
+    def session(self):
+        """ Return the HTTP session of the current thread, a released one
+            if any, so its connections are used again. """
+        if not hasattr(self.local, 'session'):
+            with self.lock:
+                self.local.session = self.idle.pop() if self.idle else \
+                                     self.requests.Session()
+        return self.local.session
+
+    def release(self):
+        """ Give up the session of the current thread, which is done with
+            its calls, for the next thread. """
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            del self.local.session
+            with self.lock:
+                self.idle.append(session)
+
+    def call(self, method, phase, action, url, kwargs):
+        """ Send the request with the session and record it. """
+        target = url.split('/')[2].split(':')[0]
+        sent = len(kwargs.get('data') or '')
+        if self.unreachable.get(target, 0) > time.time():
+            metrics.record(phase, action, target, 0.0, 0, 'unreachable')
+            raise self.requests.exceptions.ConnectionError(
+                '{0} did not answer recently'.format(target))
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, self.timeout or
+                                      CALL_TIMEOUTS.get(phase, CALL_TIMEOUT)))
+        start = time.time()
+        try:
+            response = getattr(self.session(), method)(url, **kwargs)
+        except Exception as e:
+            metrics.record(phase, action, target, time.time() - start, sent,
+                           type(e).__name__)
+            raise
+        metrics.record(phase, action, target, time.time() - start,
+                       sent + len(response.content),
+                       'ok' if response.status_code == 200 else
+                       'HTTP %d' % response.status_code)
+        return response
+
+    def post(self, url, **kwargs):
+        # SOAPACTION is "urn:schemas-upnp-org:service:AVTransport:1#Play"
+        service, _, action = kwargs.get('headers', {}).get(
+            'SOAPACTION', '').strip('"').partition('#')
+        service = service.split(':')[-2] if service.count(':') > 1 else ''
+        if action == 'Browse':
+            phase = 'browse'
+        elif 'Queue' in action:
+            phase = 'queue'
+        else:
+            phase = PHASES.get(service, service or 'soap')
+        # only reads are safe to send again
+        read = action.startswith('Get') or action == 'Browse'
+        target = url.split('/')[2].split(':')[0]
+        host = target
+        # whether the speaker itself did not answer, rather than its
+        # coordinator
+        silent = False
+        for attempt in range(self.retries + 1 if read else 1):
+            if attempt:
+                coordinator = self.coordinators.get(target)
+                if service in REROUTE and coordinator not in (None, target):
+                    # the speaker is slow or gone, ask its coordinator
+                    url = url.replace('//' + target + ':',
+                                      '//' + coordinator + ':', 1)
+                    host = coordinator
+                elif self.unreachable.get(target, 0) > time.time():
+                    break
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1) *
+                           random.uniform(0.5, 1.5))
+            try:
+                response = self.call('post', phase, action, url,
+                                     dict(kwargs))
+                if host == target:
+                    self.unreachable.pop(target, None)
+                return response
+            except (self.requests.exceptions.ConnectionError,
+                    self.requests.exceptions.Timeout) as e:
+                # a hung speaker accepts the connection and times out
+                error = e
+                silent = silent or host == target
+        if silent and self.unreachable.get(target, 0) <= time.time():
+            self.unreachable[target] = time.time() + UNREACHABLE_TTL
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.call('get', 'device', url.split('/')[-1], url, kwargs)
+
+
+class ThreadOutput(object):
+    """ Stands in for sys.stdout so each thread running the actions of a
+        target, or of a request to the server, can capture its own
+        output. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self, buffer=None):
+        """ Capture the output of the current thread, in buffer if given
+            (see current). """
+        self.local.buffer = buffer or StringIO()
+
+    def current(self):
+        """ Return the buffer capturing the current thread, or None. """
+        return getattr(self.local, 'buffer', None)
+
+    def release(self):
+        """ Stop capturing the current thread and return its output. """
+        buffer = self.local.buffer
+        self.local.buffer = None
+        return buffer.getvalue()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        (buffer or self.stream).write(text)
+
+
+def replaceFile(tmpName, fileName):
+    """ Rename the complete file tmpName to fileName, so fileName is always
+        either the old or the new file and never part of one. """
+    if os.path.isfile(fileName) and not hasattr(os, 'replace'):
+        # Python 2.7 on Windows can't rename over a file
+        os.remove(fileName)
+    getattr(os, 'replace', os.rename)(tmpName, fileName)
+
+
+def saveJson(fileName, data):
+    """ Write data as JSON to fileName through a temporary file, so runs
+        reading it at the same time see the old or the new file.  The
+        temporary name is per process and thread so writers don't mix. """
+    tmpName = '{0}.{1}.{2}.tmp'.format(fileName, os.getpid(),
+                                       threading.current_thread().ident)
+    try:
+        with open(tmpName, 'w') as fp:
+            json.dump(data, fp, indent=1, sort_keys=True)
+            fp.flush()
+            os.fsync(fp.fileno())
+        replaceFile(tmpName, fileName)
+    finally:
+        if os.path.isfile(tmpName):
+            os.remove(tmpName)
+
+
+def longestIncreasing(values):
+    """ Return the set of indexes of a longest strictly increasing
+        subsequence of values. """
+    tails = []      # index of the smallest tail of each run length
+    tailValues = []
+    previous = [None] * len(values)
+    for idx, value in enumerate(values):
+        pos = bisect.bisect_left(tailValues, value)
+        if pos > 0:
+            previous[idx] = tails[pos - 1]
+        if pos == len(tails):
+            tails.append(idx)
+            tailValues.append(value)
+        else:
+            tails[pos] = idx
+            tailValues[pos] = value
+    run = set()
+    idx = tails[-1] if tails else None
+    while idx is not None:
+        run.add(idx)
+        idx = previous[idx]
+    return run
+
+
+def trackFields(item, details):
+    """ Return the (detail, value) pairs of the track that are in
+        details.  M is the DIDL-Lite metadata of the track, which import
+        sends with the location so the speaker need not look it up. """
+    fields = []
+    for detail, attr in (('C', 'creator'), ('T', 'title'), ('A', 'album')):
+        value = getattr(item, attr, None) if detail in details else None
+        if value is not None:
+            fields.append((detail, value))
+    if 'L' in details:
+        fields.append(('L', item.resources[0].uri))
+    if 'M' in details:
+        fields.append(('M', soco.data_structures.to_didl_string(item)))
+    return fields
+
+
+class XspfWriter(object):
+    """ Formats a playlist as XSPF. """
+    tags = {'C': 'creator', 'T': 'title', 'A': 'album', 'L': 'location'}
+
+    def __init__(self, title, details):
+        self.title = title
+        self.details = details
+
+    def header(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+                ' <title>%s</title>\n'
+                ' <trackList>\n' % html.escape(self.title, True))
+
+    def track(self, item):
+        fields = trackFields(item, self.details)
+        return '  <track>\n%s%s  </track>\n' % (''.join(
+            ['   <%s>%s</%s>\n' % (self.tags[detail],
+                                   html.escape(value, True),
+                                   self.tags[detail])
+             for detail, value in fields if detail != 'M']), ''.join(
+            ['   <extension application="%s">%s</extension>\n'
+             % (DIDL_APPLICATION, html.escape(value, False))
+             for detail, value in fields if detail == 'M']))
+
+    def footer(self):
+        return ' </trackList>\n</playlist>\n'
+
+
+class M3uWriter(object):
+    """ Formats a playlist as extended M3U.  The location is always
+        written, the creator and title go in the #EXTINF line and the
+        metadata in an #EXTDIDL line. """
+
+    def __init__(self, title, details):
+        self.title = title
+        self.details = details
+
+    def header(self):
+        return '#EXTM3U\n#PLAYLIST:%s\n' % self.title
+
+    def track(self, item):
+        fields = dict(trackFields(item, self.details.replace('L', '')))
+        info = ' - '.join([fields[detail] for detail in 'CT'
+                           if detail in fields])
+        extinf = '#EXTINF:-1,%s\n' % info if info else ''
+        if 'M' in fields:
+            extinf += '#EXTDIDL:%s\n' % fields['M']
+        return extinf + item.resources[0].uri + '\n'
+
+    def footer(self):
+        return ''
+
+
+class JsonlWriter(object):
+    """ Formats a playlist as JSON lines: a header line with the title and
+        details, then one line per track keyed by the detail letters. """
+
+    def __init__(self, title, details):
+        self.title = title
+        self.details = details
+
+    def header(self):
+        return json.dumps({'playlist': self.title, 'details': self.details},
+                          ensure_ascii=False, sort_keys=True) + '\n'
+
+    def track(self, item):
+        return json.dumps(dict(trackFields(item, self.details)),
+                          ensure_ascii=False, sort_keys=True,
+                          separators=(',', ':')) + '\n'
+
+    def footer(self):
+        return ''
+
+
+def readXspf(fp, fileName):
+    """ Yield ('title', title), ('location', uri) and, after the location
+        when the track has it, ('metadata', didl) for an XSPF file as it is
+        parsed.  Finished tracks are dropped so memory stays flat. """
+    ns = '{http://xspf.org/ns/0/}'
+    depth = 0
+    trackList = None
+    location = metadata = None
+    for event, elem in ET.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0 and elem.tag != ns+'playlist':
+                raise ValueError('file is not an xspf file: ' + fileName)
+            if elem.tag == ns+'trackList':
+                trackList = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == ns+'title':
+            yield 'title', elem.text or ''
+        elif elem.tag == ns+'location' and elem.text and location is None:
+            location = unescape(elem.text)
+        elif elem.tag == ns+'extension' and \
+             elem.get('application') == DIDL_APPLICATION:
+            metadata = elem.text
+        elif elem.tag == ns+'track':
+            if location:
+                yield 'location', location
+                if metadata:
+                    yield 'metadata', metadata
+            location = metadata = None
+            if trackList is not None:
+                del trackList[:]
+
+
+def readM3u(fp, fileName):
+    """ Yield ('title', title), ('location', uri) and ('metadata', didl)
+        for an M3U file.  The title is from #PLAYLIST, or else the file
+        name. """
+    title = None
+    metadata = None
+    for line in fp:
+        line = line.decode('utf-8').lstrip(u'\ufeff').strip()
+        if line.startswith('#PLAYLIST:') and title is None:
+            title = line[len('#PLAYLIST:'):].strip()
+            yield 'title', title
+        elif line.startswith('#EXTDIDL:'):
+            metadata = line[len('#EXTDIDL:'):]
+        elif line and not line.startswith('#'):
+            if title is None:
+                title = os.path.splitext(os.path.basename(fileName))[0]
+                yield 'title', title
+            yield 'location', line
+            if metadata:
+                yield 'metadata', metadata
+            metadata = None
+    if title is None:
+        yield 'title', os.path.splitext(os.path.basename(fileName))[0]
+
+
+def readJsonl(fp, fileName):
+    """ Yield ('title', title), ('location', uri) and ('metadata', didl)
+        for a JSON lines file. """
+    for number, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            raise ValueError('invalid JSON on line %d of %s'
+                             % (number, fileName))
+        if 'playlist' in record:
+            yield 'title', record['playlist']
+        elif record.get('L'):
+            yield 'location', record['L']
+            if record.get('M'):
+                yield 'metadata', record['M']
+
+
+# export and import formats by file name suffix: writer, reader
+FORMATS = {
+    'xspf': (XspfWriter, readXspf),
+    'xspf.gz': (XspfWriter, readXspf),
+    'm3u': (M3uWriter, readM3u),
+    'jsonl': (JsonlWriter, readJsonl),
+    'jsonl.gz': (JsonlWriter, readJsonl),
+}
+
+
+def fileFormat(fileName):
+    """ Return the format of the file from its name, XSPF if the suffix is
+        not known. """
+    name = fileName.lower()
+    if name.endswith('.m3u8'):
+        return 'm3u'
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith('.' + fmt):
+            return fmt
+    return 'xspf'
+
+
 class SPL:
     """ Main class."""
 
@@ -71,7 +669,10 @@ class SPL:
 
     def getPlayMode(self, speaker):
         """ Retrieve the play mode and cross fade from the speaker. """
-        mode = speaker.play_mode
+        return self.formatPlayMode(speaker.play_mode, speaker.cross_fade)
+
+    def formatPlayMode(self, mode, crossFade):
+        """ Format the play mode and cross fade like the -m option. """
         if mode == 'NORMAL':
             pm = 'sr'
         elif mode == 'REPEAT_ALL':
@@ -83,13 +684,268 @@ class SPL:
         else:
             print('Error: speaker gave an unknown play_mode: ' + mode)
             pm = 'xx'
-        if speaker.cross_fade == True:
+        if crossFade == True:
             return pm + 'F'
         return pm + 'f'
 
 
-    def queue(self, speaker, pl, playMode):
-        """ Replace queue on speaker with playlist. """
+    def speakerStatus(self, zone, independent):
+        """ Return the status of the zone as a dict.  Only the volume is
+            read from a speaker that is not its group coordinator. """
+        status = {}
+        if independent:
+            tranInfo = zone.get_current_transport_info()
+            status['state'] = tranInfo[u'current_transport_state']
+            status['mode'] = self.getPlayMode(zone)
+        status['volume'] = zone.volume
+        if independent:
+            info = zone.get_current_track_info()
+            status['artist'] = info[u'artist']
+            status['title'] = info[u'title']
+        return status
+
+
+    def listSpeakerInfo(self, zones, party, timeout, asJson):
+        """ Print the status of the zones, sorted by name.  The speakers are
+            asked at the same time and a speaker that does not answer within
+            timeout seconds is reported as timed out. """
+        zones = sorted(zones, key=lambda dev: dev.player_name)
+        infos = []
+        for zone in zones:
+            info = {'name': zone.player_name, 'ip': zone.ip_address}
+            info['independent'] = True
+            if party:
+                coordinator = zone.group.coordinator
+                info['coordinator'] = coordinator.player_name
+                info['independent'] = zone == coordinator
+            infos.append(info)
+        def status(idx):
+            cached = self.cachedStatus(zones[idx], infos[idx]['independent'])
+            if cached:
+                return cached
+            return self.speakerStatus(zones[idx], infos[idx]['independent'])
+        results = self.runJobs(status, list(range(len(zones))), len(zones),
+                               timeout)
+        for info, result in zip(infos, results):
+            if isinstance(result, socket.timeout):
+                info['error'] = 'timed out'
+            elif isinstance(result, Exception):
+                info['error'] = str(result) or result.__class__.__name__
+            else:
+                info.update(result)
+
+        if asJson:
+            print(json.dumps(infos, indent=1, sort_keys=True))
+            return
+        for info in infos:
+            print(info['name'])
+            print('  IP : ' + info['ip'])
+            if party:
+                print('  group coordinator : ' + info['coordinator'])
+            for key in ('state', 'mode', 'volume', 'artist', 'title'):
+                if info.get(key) not in (None, ''):
+                    print('  %s : %s' % (key, info[key]))
+            if info.get('error') == 'timed out':
+                print('Error: speaker did not answer within %g seconds.' %
+                      timeout)
+            elif 'error' in info:
+                print('Error: cannot communicate with the speaker.')
+
+
+    def cachedStatus(self, zone, independent):
+        """ Return the status of the zone from the state kept by watch, or
+            None if it is not known. """
+        keys = ['volume']
+        if independent:
+            keys += ['state', 'mode', 'artist', 'title']
+        with self.stateLock:
+            info = self.state.get(zone.ip_address, {})
+            if [key for key in keys if key not in info]:
+                return None
+            return dict((key, info[key]) for key in keys)
+
+
+    def applyEvent(self, event):
+        """ Update the state kept by watch from a UPnP event.  Returns the
+            values that changed, by speaker name. """
+        var = event.variables
+        updates = {}
+        if event.service.service_type == 'ZoneGroupTopology':
+            if 'zone_group_state' not in var:
+                return {}
+            tree = ET.fromstring(var['zone_group_state'].encode('utf-8'))
+            for group in tree.iter('ZoneGroup'):
+                members = group.findall('ZoneGroupMember')
+                names = dict([(member.get('UUID'), member.get('ZoneName'))
+                              for member in members])
+                for member in members:
+                    ip = member.get('Location').split('//')[1].split(':')[0]
+                    updates[ip] = {
+                        'name': member.get('ZoneName'),
+                        'coordinator': names.get(group.get('Coordinator'))}
+        else:
+            new = {}
+            if 'transport_state' in var:
+                new['state'] = var['transport_state']
+            if 'current_play_mode' in var:
+                new['playMode'] = var['current_play_mode']
+            if 'current_crossfade_mode' in var:
+                new['crossFade'] = var['current_crossfade_mode'] == '1'
+            if 'current_track_meta_data' in var:
+                meta = var['current_track_meta_data']
+                new['artist'] = getattr(meta, 'creator', '')
+                new['title'] = getattr(meta, 'title', '')
+            if 'volume' in var:
+                new['volume'] = int(var['volume']['Master'])
+            updates[event.service.soco.ip_address] = new
+
+        changes = {}
+        with self.stateLock:
+            for ip, new in updates.items():
+                info = self.state.setdefault(ip, {'ip': ip})
+                diff = dict([(key, value) for key, value in new.items()
+                             if info.get(key) != value])
+                info.update(diff)
+                if 'playMode' in info and 'crossFade' in info:
+                    mode = self.formatPlayMode(info['playMode'],
+                                               info['crossFade'])
+                    if info.get('mode') != mode:
+                        info['mode'] = diff['mode'] = mode
+                diff.pop('playMode', None)
+                diff.pop('crossFade', None)
+                if diff:
+                    changes[info.get('name', ip)] = diff
+        return changes
+
+
+    def watch(self, zones, stream):
+        """ Subscribe to the AVTransport, RenderingControl and
+            ZoneGroupTopology events of the zones and keep the state of the
+            speakers up to date from them, without polling.  With stream
+            each change is printed as a line of JSON until interrupted,
+            otherwise the events are handled in the background. """
+        events = queue.Queue()
+        subscriptions = []
+        for zone in zones:
+            with self.stateLock:
+                self.state.setdefault(zone.ip_address, {}).update(
+                    {'ip': zone.ip_address, 'name': zone.player_name})
+            services = [zone.avTransport, zone.renderingControl]
+            if not subscriptions:
+                # every zone has the same topology
+                services.append(zone.zoneGroupTopology)
+            for service in services:
+                try:
+                    subscriptions.append(service.subscribe(
+                        auto_renew=True, event_queue=events))
+                except:
+                    print('Error: cannot subscribe to the events of ' +
+                          zone.player_name)
+                    if self.verbose:
+                        traceback.print_exc()
+
+        def handle():
+            while True:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    continue
+                try:
+                    changes = self.applyEvent(event)
+                except:
+                    if self.verbose:
+                        traceback.print_exc()
+                    continue
+                if stream:
+                    for name in sorted(changes):
+                        print(json.dumps({'time': event.timestamp,
+                                          'speaker': name,
+                                          'changes': changes[name]},
+                                         sort_keys=True))
+                    sys.stdout.flush()
+
+        if not stream:
+            thread = threading.Thread(target=handle)
+            thread.daemon = True
+            thread.start()
+            return
+        try:
+            handle()
+        except KeyboardInterrupt:
+            pass
+        for subscription in subscriptions:
+            try:
+                subscription.unsubscribe()
+            except:
+                pass
+        soco.events.event_listener.stop()
+
+
+    def groupCall(self, speakers, func, timeout, action):
+        """ Call func for every speaker at the same time, waiting at most
+            timeout seconds.  The failures are reported together.  Returns
+            the results, the exception for a failed speaker. """
+        results = self.runJobs(func, speakers, len(speakers), timeout)
+        failed = 0
+        for speaker, result in zip(speakers, results):
+            if isinstance(result, Exception):
+                failed += 1
+                print('Error: {0}: {1}'.format(speaker.player_name, result))
+        if failed:
+            print('Error: {0} failed on {1} of {2} speakers.'.format(
+                  action, failed, len(speakers)))
+        return results
+
+
+    def setGroupVolume(self, coordinator, volume, relative, timeout):
+        """ Set the volume of the group of the coordinator, or change it by
+            volume if relative.  The group rendering control scales every
+            member in one call so the balance between rooms is kept.  If the
+            speaker does not support it, the member volumes are read and
+            set at the same time, scaled by the same factor. """
+        group = soco.services.GroupRenderingControl(coordinator)
+        try:
+            group.SnapshotGroupVolume([('InstanceID', 0)])
+            if relative:
+                group.SetRelativeGroupVolume([('InstanceID', 0),
+                                              ('Adjustment', volume)])
+            else:
+                group.SetGroupVolume([('InstanceID', 0),
+                                      ('DesiredVolume', volume)])
+            return
+        except soco.exceptions.SoCoUPnPException:
+            if self.verbose:
+                traceback.print_exc()
+
+        members = coordinator.group.members
+        volumes = self.groupCall(members, lambda member: member.volume,
+                                 timeout, 'Reading the volume')
+        current = {}
+        for member, vol in zip(members, volumes):
+            if not isinstance(vol, Exception):
+                current[member] = vol
+        if not current:
+            return
+        average = float(sum(current.values())) / len(current)
+        target = max(0, min(100, average + volume if relative else volume))
+        def scale(member):
+            if average:
+                member.volume = max(0, min(100, int(round(
+                    current[member] * target / average))))
+            else:
+                member.volume = int(round(target))
+        self.groupCall(list(current), scale, timeout, 'Setting the volume')
+
+
+    def topologyChanged(self, zones):
+        """ Forget the group topology after joining or leaving groups. """
+        soco.core.zone_group_state_shared_cache.clear()
+        self.saveZoneCache(zones)
+
+
+    def queue(self, speaker, index, pl, playMode):
+        """ Replace queue on speaker with playlist.  The track count for a
+            random start is from the playlist index. """
         try:
             speaker.clear_queue()
         except:
@@ -97,7 +953,12 @@ class SPL:
             pass
         speaker.add_to_queue(pl)
         if 'S' in playMode:
-            idx = random.randint(0, speaker.queue_size-1)
+            tracks = index['byTitle'][pl.title]['tracks']
+            if tracks is None:
+                checks = self.checkPls(speaker, [pl], 1)
+                self.recordPlaylists(index, [pl], checks)
+                tracks = index['byTitle'][pl.title]['tracks'] or 0
+            idx = random.randint(0, max(tracks, 1) - 1)
         else:
             idx = 0
         try:
@@ -108,132 +969,1665 @@ class SPL:
                 traceback.print_exc()
 
 
-    def exportPl(self, speaker, pl, force, details):
-        """ Export playlist from speaker to an XSPF file. """
-        fileName = pl.title.replace('/', '_').replace('\\', '_') + '.xspf'
+    def browsePages(self, speaker, item):
+        """ Generate the pages of the children of item.  The next page is
+            fetched in the background while the caller handles the current
+            one.  The page size grows while the speaker answers quickly, up
+            to what it returns per call, and total_matches from the first
+            page ends the paging without asking for an empty page. """
+        try:
+            # MusicLibrary only available 0.12 and later
+            browse = soco.music_library.MusicLibrary(speaker).browse
+        except:
+            # MusicLibrary not available
+            browse = speaker.browse
+
+        # one worker fetches every page, so they share its HTTP session and
+        # connection
+        wanted = queue.Queue()
+        fetched = queue.Queue()
+
+        def worker():
+            while True:
+                request = wanted.get()
+                if request is None:
+                    soco.services.requests.release()
+                    return
+                result = {}
+                begin = time.time()
+                try:
+                    result['page'] = browse(item, start=request[0],
+                                            max_items=request[1])
+                except Exception as e:
+                    result['error'] = e
+                result['elapsed'] = time.time() - begin
+                fetched.put(result)
+
+        prefetch = threading.Thread(target=worker)
+        prefetch.daemon = True
+        prefetch.start()
+        start = 0
+        maxItems = PAGE_MIN
+        pageMax = PAGE_MAX
+        total = None
+        try:
+            wanted.put((start, maxItems))
+            while True:
+                result = fetched.get()
+                if 'error' in result:
+                    raise result['error']
+                page = result['page']
+                if not page:
+                    break
+                if total is None:
+                    total = getattr(page, 'total_matches', None)
+                start += len(page)
+                if len(page) < maxItems:
+                    # the speaker returns no more than this per call
+                    pageMax = max(len(page), PAGE_MIN)
+                if result['elapsed'] < PAGE_TARGET:
+                    maxItems = min(maxItems * 2, pageMax)
+                elif result['elapsed'] > 2 * PAGE_TARGET:
+                    maxItems = max(maxItems // 2, PAGE_MIN)
+                else:
+                    maxItems = min(maxItems, pageMax)
+                if total is not None and start >= total:
+                    yield page
+                    break
+                # fetch the next page while the caller handles this one
+                wanted.put((start, maxItems))
+                yield page
+        finally:
+            # also when the caller stops early
+            wanted.put(None)
+
+
+    def exportFileName(self, pl, fmt):
+        """ Name of the export file of the playlist in the format. """
+        return pl.title.replace('/', '_').replace('\\', '_') + '.' + fmt
+
+
+    def exportPath(self, fileName):
+        """ Path of an export file, in the directory of the target whose
+            actions the current thread runs (see runTargets). """
+        return os.path.join(getattr(self.local, 'directory', ''), fileName)
+
+
+    def exportPl(self, speaker, pl, force, details, fmt):
+        """ Export playlist from speaker to a file in the format.  The file
+            is written under a temporary name and renamed when complete, so
+            a failed export never leaves a truncated file. """
+        fileName = self.exportPath(self.exportFileName(pl, fmt))
         if not force and os.path.isfile(fileName):
-            print('Error: file already exists: ' + fileName)
-            return
+            return None, 'Error: file already exists: ' + fileName
+        writer = FORMATS[fmt][0](pl.title, details)
+        tmpName = fileName + '.tmp'
         try:
-            with codecs.open(fileName, 'w', 'utf-8') as fp:
-                fp.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-                fp.write('<playlist version="1" xmlns="http://xspf.org/ns/0/">\n')
-                fp.write(' <title>%s</title>\n' % pl.title)
-                fp.write(' <trackList>\n')
-                start = 0
-                max_items = 100
+            with open(tmpName, 'wb', WRITE_BUFFER) as raw:
+                if fmt.endswith('.gz'):
+                    fp = gzip.GzipFile(os.path.basename(fileName), 'wb', 6,
+                                       raw)
+                else:
+                    fp = raw
+                fp.write(writer.header().encode('utf-8'))
                 cnt = 0
-                try:
-                    # MusicLibrary only available 0.12 and later
-                    ml = soco.music_library.MusicLibrary(speaker)
-                    mlAvailable = True
-                except:
-                    # MusicLibrary not available
-                    mlAvailable = False
-                while True:
-                    if mlAvailable:
-                        trackList = ml.browse(pl, start=start,
-                                              max_items=max_items)
+                written = 0
+                writing = 0.0
+                for trackList in self.browsePages(speaker, pl):
+                    # one write per page
+                    data = ''.join([writer.track(item)
+                                    for item in trackList]).encode('utf-8')
+                    start = time.time()
+                    fp.write(data)
+                    writing += time.time() - start
+                    written += len(data)
+                    cnt += len(trackList)
+                start = time.time()
+                fp.write(writer.footer().encode('utf-8'))
+                if fp is not raw:
+                    fp.close()
+                raw.flush()
+                os.fsync(raw.fileno())
+                writing += time.time() - start
+            metrics.record('write', fmt, 'local', writing, written, 'ok')
+            replaceFile(tmpName, fileName)
+        except (IOError, OSError) as e:
+            return None, "Error: file {0}: {1}".format(fileName,
+                                                      e.strerror or e)
+        finally:
+            if os.path.isfile(tmpName):
+                os.remove(tmpName)
+        return cnt, pl.title + ': ' + str(cnt) + ' songs'
+
+
+    def exportPls(self, speaker, pls, force, details, fmt, jobs):
+        """ Export the playlists, jobs at a time.  The results are printed
+            in playlist order and one failed export does not stop the
+            others.  Returns the track counts, None for a failed export. """
+        def export(pl):
+            return self.exportPl(speaker, pl, force, details, fmt)
+        counts = []
+        for pl, result in zip(pls, self.runJobs(export, pls, jobs)):
+            if isinstance(result, Exception):
+                print('Error: export of playlist {0} failed: {1}'.format(
+                      pl.title, result))
+                counts.append(None)
+            else:
+                counts.append(result[0])
+                print(result[1])
+        return counts
+
+
+    def loadManifest(self):
+        """ Return the manifest of the last export in the export
+            directory. """
+        try:
+            with open(self.exportPath(MANIFEST), 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {'playlists': {}}
+
+
+    def saveManifest(self, manifest):
+        """ Save the manifest of the export in the export directory. """
+        try:
+            saveJson(self.exportPath(MANIFEST), manifest)
+        except (IOError, OSError) as e:
+            print("Error: file {0}: {1}".format(self.exportPath(MANIFEST),
+                                                 e.strerror))
+
+
+    def checkPls(self, speaker, pls, jobs):
+        """ Return the (update ID, track count) of each playlist, from a one
+            track browse.  A failed check is the exception. """
+        ml = soco.music_library.MusicLibrary(speaker)
+        def check(pl):
+            page = ml.browse(pl, start=0, max_items=1)
+            return page.update_id, page.total_matches
+        return self.runJobs(check, pls, jobs)
+
+
+    def exportChangedPls(self, speaker, index, pls, details, fmt, jobs):
+        """ Export the playlists whose update ID or track count changed
+            since the export recorded in the manifest.  index is the playlist
+            index of the speaker, pls the playlists to export. """
+        manifest = self.loadManifest()
+        recorded = manifest['playlists']
+        if manifest.get('details') != details:
+            recorded = {}
+        containerId = index['containerUpdateId']
+        allPls = len(pls) == len(index['playlists'])
+        if containerId is not None and \
+           manifest.get('containerUpdateId') == containerId and \
+           not [pl for pl in pls if pl.title not in recorded or
+                recorded[pl.title]['file'] != self.exportFileName(pl, fmt) or
+                not os.path.isfile(self.exportPath(
+                    recorded[pl.title]['file']))]:
+            # no saved playlist changed since the last export
+            print('All playlists unchanged.')
+            return
+
+        changed = []
+        current = {}
+        checks = self.checkPls(speaker, pls, jobs)
+        self.recordPlaylists(index, pls, checks)
+        for pl, result in zip(pls, checks):
+            if isinstance(result, Exception):
+                print('Error: cannot check playlist {0}: {1}'.format(
+                      pl.title, result))
+                allPls = False
+                continue
+            entry = {'itemId': pl.item_id, 'updateId': result[0],
+                     'tracks': result[1],
+                     'file': self.exportFileName(pl, fmt)}
+            old = recorded.get(pl.title)
+            if old and os.path.isfile(self.exportPath(old['file'])) and \
+               [old.get(key) for key in entry] == \
+               [entry[key] for key in entry]:
+                print(pl.title + ': unchanged')
+            else:
+                changed.append(pl)
+            current[pl.title] = entry
+
+        for pl, count in zip(changed,
+                             self.exportPls(speaker, changed, True, details,
+                                            fmt, jobs)):
+            if count is None:
+                del current[pl.title]
+                allPls = False
+
+        # keep the playlists that were not exported this time
+        if not allPls or len(pls) != len(index['playlists']):
+            for title in recorded:
+                current.setdefault(title, recorded[title])
+        manifest = {'details': details, 'playlists': current,
+                    'containerUpdateId': containerId if allPls else
+                                         manifest.get('containerUpdateId')}
+        self.saveManifest(manifest)
+
+
+    def exportArchive(self, speaker, index, pls, details, fileName, jobs):
+        """ Export the playlists into one SQLite archive that stores each
+            distinct track once, keyed by URI.  Playlists whose update ID
+            and track count did not change since the last export are
+            skipped.  When pls is every playlist on the speaker, playlists
+            that were deleted from the speaker are dropped. """
+        try:
+            conn = sqlite3.connect(fileName)
+        except sqlite3.Error as e:
+            print('Error: archive {0}: {1}'.format(fileName, e))
+            return
+        try:
+            conn.executescript(ARCHIVE_SCHEMA)
+            self.upgradeArchive(conn)
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+            recorded = {}
+            if meta.get('details') == details:
+                for title, itemId, updateId, tracks in conn.execute(
+                        'SELECT title, itemId, updateId, tracks'
+                        ' FROM playlists'):
+                    recorded[title] = (itemId, updateId, tracks)
+            containerId = index['containerUpdateId']
+            allPls = len(pls) == len(index['playlists'])
+            if containerId is not None and \
+               meta.get('containerUpdateId') == str(containerId) and \
+               not [pl for pl in pls if pl.title not in recorded]:
+                # no saved playlist changed since the last export
+                print('All playlists unchanged.')
+                return
+
+            changed = []
+            checks = self.checkPls(speaker, pls, jobs)
+            self.recordPlaylists(index, pls, checks)
+            for pl, result in zip(pls, checks):
+                if isinstance(result, Exception):
+                    print('Error: cannot check playlist {0}: {1}'.format(
+                          pl.title, result))
+                    allPls = False
+                elif recorded.get(pl.title) == (pl.item_id,) + tuple(result):
+                    print(pl.title + ': unchanged')
+                else:
+                    changed.append(pl)
+
+            def fetch(pl):
+                updateId = None
+                rows = []
+                for page in self.browsePages(speaker, pl):
+                    if updateId is None:
+                        updateId = page.update_id
+                    for item in page:
+                        fields = dict(trackFields(item,
+                                                  details.replace('L', '')))
+                        rows.append((item.resources[0].uri, fields.get('C'),
+                                     fields.get('T'), fields.get('A'),
+                                     fields.get('M')))
+                return updateId, rows
+
+            def fetched():
+                # a batch of jobs playlists at a time, so at most that many
+                # are held in memory
+                for start in range(0, len(changed), jobs):
+                    batch = changed[start:start + jobs]
+                    for pl, result in zip(batch, self.runJobs(fetch, batch,
+                                                              jobs)):
+                        yield pl, result
+
+            # the ID and a hash of the fields of each stored track
+            tracks = {}
+            for row in conn.execute('SELECT uri, id, creator, title, album,'
+                                    ' didl FROM tracks'):
+                tracks[row[0]] = (row[1], hash(row[2:]))
+            for pl, result in fetched():
+                if isinstance(result, Exception):
+                    print('Error: export of playlist {0} failed: {1}'.format(
+                          pl.title, result))
+                    allPls = False
+                    continue
+                updateId, rows = result
+                ids = []
+                for uri, creator, title, album, didl in rows:
+                    known = tracks.get(uri)
+                    fields = hash((creator, title, album, didl))
+                    if known is None:
+                        trackId = conn.execute(
+                            'INSERT INTO tracks (uri, creator, title, album,'
+                            ' didl) VALUES (?, ?, ?, ?, ?)',
+                            (uri, creator, title, album, didl)).lastrowid
+                        tracks[uri] = (trackId, fields)
                     else:
-                        trackList = speaker.browse(pl, start=start,
-                                                   max_items=max_items)
-                    if not trackList:
-                        break       # done
-                    for item in trackList:
-                        #pprint(item.__class__.__name__)
-                        #pprint(item.__dict__)
-                        #for res in item.resources:
-                        #    pprint(res.__class__.__name__)
-                        #    pprint(res.__dict__)
-                        fp.write('  <track>\n')
-                        if 'C' in details and hasattr(item, 'creator'):
-                            creator = html.escape(item.creator, True)
-                            fp.write('   <creator>%s</creator>\n' % creator)
-                        if 'T' in details and hasattr(item, 'title'):
-                            title = html.escape(item.title, True)
-                            fp.write('   <title>%s</title>\n' % title)
-                        if 'A' in details and hasattr(item, 'album'):
-                            album = html.escape(item.album, True)
-                            fp.write('   <album>%s</album>\n' % album)
-                        if 'L' in details:
-                            loc = html.escape(item.resources[0].uri, True)
-                            fp.write('   <location>%s</location>\n' % loc)
-                        fp.write('  </track>\n')
-                        cnt += 1
-                    start += max_items
-                fp.write(' </trackList>\n')
-                fp.write('</playlist>\n')
-        except IOError as e:
-            print("Error: file {0}: {1}".format(fileName, e.strerror))
+                        trackId = known[0]
+                        if known[1] != fields:
+                            conn.execute('UPDATE tracks SET creator = ?,'
+                                         ' title = ?, album = ?, didl = ?'
+                                         ' WHERE id = ?',
+                                         (creator, title, album, didl,
+                                          trackId))
+                            tracks[uri] = (trackId, fields)
+                    ids.append(trackId)
+                conn.execute('DELETE FROM entries WHERE playlist IN'
+                             ' (SELECT id FROM playlists WHERE title = ?)',
+                             (pl.title,))
+                conn.execute('DELETE FROM playlists WHERE title = ?',
+                             (pl.title,))
+                plId = conn.execute(
+                    'INSERT INTO playlists (title, itemId, updateId, tracks,'
+                    ' time) VALUES (?, ?, ?, ?, ?)',
+                    (pl.title, pl.item_id, updateId, len(ids),
+                     time.time())).lastrowid
+                conn.executemany('INSERT INTO entries (playlist, position,'
+                                 ' track) VALUES (?, ?, ?)',
+                                 [(plId, position, trackId)
+                                  for position, trackId in enumerate(ids)])
+                print(pl.title + ': ' + str(len(ids)) + ' songs')
+
+            if len(pls) == len(index['playlists']):
+                # drop the playlists deleted from the speaker
+                for plId, title in conn.execute(
+                        'SELECT id, title FROM playlists').fetchall():
+                    if title not in index['byTitle']:
+                        conn.execute('DELETE FROM entries WHERE playlist = ?',
+                                     (plId,))
+                        conn.execute('DELETE FROM playlists WHERE id = ?',
+                                     (plId,))
+            conn.execute('DELETE FROM tracks WHERE id NOT IN'
+                         ' (SELECT track FROM entries)')
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('details', details))
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('containerUpdateId',
+                          str(containerId) if allPls and
+                          containerId is not None else ''))
+            conn.commit()
+        except sqlite3.Error as e:
+            print('Error: archive {0}: {1}'.format(fileName, e))
+        finally:
+            conn.close()
+
+
+    def upgradeArchive(self, conn):
+        """ Add the metadata column missing from older archives. """
+        if 'didl' not in [row[1] for row in
+                          conn.execute('PRAGMA table_info(tracks)')]:
+            conn.execute('ALTER TABLE tracks ADD COLUMN didl TEXT')
+
+
+    def archiveRecords(self, conn, plId, title):
+        """ Yield the ('title', title), ('location', uri) and ('metadata',
+            didl) records of a playlist in the archive, like the file
+            readers. """
+        yield 'title', title
+        for uri, didl in conn.execute('SELECT uri, didl FROM entries JOIN'
+                                      ' tracks ON tracks.id = entries.track'
+                                      ' WHERE playlist = ? ORDER BY position',
+                                      (plId,)):
+            yield 'location', uri
+            if didl:
+                yield 'metadata', didl
+
+
+    def restoreArchive(self, speaker, fileName, titles, batchSize, sync):
+        """ Import the playlists in titles, or all the playlists, from the
+            archive. """
+        if not os.path.isfile(fileName):
+            print('Error: file {0}: No such file'.format(fileName))
+            return
+        try:
+            conn = sqlite3.connect(fileName)
+        except sqlite3.Error as e:
+            print('Error: archive {0}: {1}'.format(fileName, e))
+            return
+        try:
+            self.upgradeArchive(conn)
+            pls = conn.execute('SELECT id, title FROM playlists'
+                               ' ORDER BY title').fetchall()
+            if titles:
+                found = set([title for plId, title in pls])
+                for title in titles:
+                    if title not in found:
+                        print('Error: playlist "%s" is not in the archive.'
+                              % title)
+                pls = [pl for pl in pls if pl[1] in titles]
+            for plId, title in pls:
+                print(title)
+                self.importRecords(speaker,
+                                   self.archiveRecords(conn, plId, title),
+                                   fileName, batchSize, sync)
+        except sqlite3.Error as e:
+            print('Error: archive {0}: {1}'.format(fileName, e))
+            if self.verbose:
+                traceback.print_exc()
+        except Exception as e:
+            print('Error: {0}'.format(e))
+            if self.verbose:
+                traceback.print_exc()
+        finally:
+            conn.close()
+
+
+    def indexLibrary(self, speaker, jobs):
+        """ Index the tracks of the music library of the speaker, with their
+            genre, in ~/.spl/library.db for -q queries.  Nothing more is
+            read while the update ID of the library is unchanged; otherwise
+            the library is read again, the genres jobs at a time, and only
+            the rows that changed are written. """
+        ds = soco.data_structures
+        allTracks = ds.DidlContainer(title='Tracks', parent_id='A:',
+                                     item_id='A:TRACKS')
+        fileName = os.path.join(CACHE_DIR, LIBRARY_INDEX)
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            conn = sqlite3.connect(fileName)
+            conn.executescript(LIBRARY_SCHEMA)
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+        except sqlite3.Error as e:
+            print('Error: library index {0}: {1}'.format(fileName, e))
             return
-        print(pl.title + ': ' + str(cnt) + ' songs')
-
-
-    def importPl(self, speaker, fileName):
-        """ Import playlist from file to speaker. """
-        try:
-            with open(fileName, 'r') as fp:
-                state = 'checkFile'
-                firstTrack = True
-                ns = '{http://xspf.org/ns/0/}'
-                context = ET.iterparse(fp, events=('start', 'end'))
-
-                for event, elem in context:
-                    #print('State: %s Event: %s Tag: %s' % \
-                    #      (state, event, elem.tag))
-                    if state == 'checkFile':
-                        if elem.tag == ns+'playlist':
-                            state = 'findTitle'
-                        else:
-                            print('Error: file is not an xspf file: '+ fileName)
-                            return
-                    elif state == 'findTitle':
-                        if elem.tag == ns+'title' and event == 'start':
-                            #print(elem.text)
-                            plName = elem.text
-                            foundIt = False
-                            for pl in speaker.get_sonos_playlists():
-                                if pl.title == plName:
-                                    foundIt = True
-                            if foundIt:
-                                print('Error: Sonos playlist "%s" already'
-                                      ' exists.  The playlist must be deleted'
-                                      ' before importing.' % plName)
-                                return
-                            state = 'findLocation'
-                    elif state == 'findLocation':
-                        if elem.tag == ns+'location' and event == 'end':
-                            if firstTrack:
-                                speaker.clear_queue()
-                                firstTrack = False
-                            # process the track
-                            print('.', end='')
-                            sys.stdout.flush()
-                            speaker.add_uri_to_queue(unescape(elem.text))
-                if not firstTrack:
-                    print('')
-            speaker.create_sonos_playlist_from_queue(plName)
+        updateId = getattr(soco.music_library.MusicLibrary(speaker).browse(
+            allTracks, start=0, max_items=1), 'update_id', None)
+        if updateId is not None and meta.get('updateId') == str(updateId):
+            print('Library unchanged: {0} tracks.'.format(meta['tracks']))
+            conn.close()
+            return
+
+        def genreTracks(genre):
+            # the tracks of a genre are listed under A:GENRE/<genre>//;
+            # containers listed there are read as well
+            containers = [ds.DidlContainer(title=genre.title,
+                                           parent_id=genre.item_id,
+                                           item_id=genre.item_id + '//')]
+            seen = set()
+            uris = []
+            while containers:
+                container = containers.pop(0)
+                if container.item_id in seen:
+                    continue
+                seen.add(container.item_id)
+                for page in self.browsePages(speaker, container):
+                    for item in page:
+                        if item.resources:
+                            uris.append(item.resources[0].uri)
+                        elif isinstance(item, ds.DidlContainer):
+                            containers.append(item)
+            return uris
+
+        try:
+            changed = 0
+            conn.execute('CREATE TEMP TABLE seen (uri TEXT PRIMARY KEY,'
+                         ' genre TEXT)')
+            count = 0
+            for page in self.browsePages(speaker, allTracks):
+                rows = []
+                for item in page:
+                    if not item.resources:
+                        continue
+                    fields = dict(trackFields(item, 'ACLMT'))
+                    rows.append((fields.get('C'), fields.get('A'),
+                                 fields.get('T'),
+                                 getattr(item, 'original_track_number', None),
+                                 fields['M'], fields['L']))
+                conn.executemany('INSERT OR IGNORE INTO seen (uri)'
+                                 ' VALUES (?)', [row[-1:] for row in rows])
+                conn.executemany('INSERT OR IGNORE INTO tracks (uri)'
+                                 ' VALUES (?)', [row[-1:] for row in rows])
+                changed += conn.executemany(
+                    'UPDATE tracks SET artist = ?, album = ?, title = ?,'
+                    ' track = ?, didl = ? WHERE uri = ? AND NOT (artist IS ?1'
+                    ' AND album IS ?2 AND title IS ?3 AND track IS ?4 AND'
+                    ' didl IS ?5)', rows).rowcount
+                count += len(rows)
+            removed = conn.execute('DELETE FROM tracks WHERE uri NOT IN'
+                                   ' (SELECT uri FROM seen)').rowcount
+
+            genres = [genre for page in self.browsePages(
+                          speaker, ds.DidlContainer(title='Genres',
+                                                    parent_id='A:',
+                                                    item_id='A:GENRE'))
+                      for genre in page]
+            for genre, uris in zip(genres, self.runJobs(genreTracks, genres,
+                                                        jobs)):
+                if isinstance(uris, Exception):
+                    print('Error: cannot read genre {0}: {1}'.format(
+                          genre.title, uris))
+                    continue
+                conn.executemany('UPDATE seen SET genre = ? WHERE uri = ?',
+                                 [(genre.title, uri) for uri in uris])
+            regenred = conn.execute('UPDATE tracks SET genre = (SELECT genre'
+                                    ' FROM seen WHERE seen.uri = tracks.uri)'
+                                    ' WHERE genre IS NOT (SELECT genre FROM'
+                                    ' seen WHERE seen.uri = tracks.uri)'
+                                    ).rowcount
+            conn.execute('DROP TABLE seen')
+            conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             [('updateId', str(updateId)),
+                              ('tracks', str(count))])
+            conn.commit()
+            print('Library indexed: {0} tracks in {1} genres, {2} new or'
+                  ' changed, {3} removed, {4} with a new genre.'.format(
+                  count, len(genres), changed, removed, regenred))
+        except sqlite3.Error as e:
+            print('Error: library index {0}: {1}'.format(fileName, e))
+        finally:
+            conn.close()
+
+
+    def queryLibrary(self, query):
+        """ Return the (uri, didl) of the tracks of the library index that
+            match the query, in artist, album and track order.  The query is
+            terms such as 'artist:"Miles Davis" genre:Jazz', where * matches
+            anything and a word without a field matches the artist, album or
+            title.  Terms of the same field match any of them, terms of
+            different fields must all match.  Returns None if the text is
+            not a query, and raises ValueError for an invalid one. """
+        def fielded(terms):
+            return [term for term in terms if ':' in term and
+                    term.split(':', 1)[0].lower() in QUERY_FIELDS]
+
+        try:
+            terms = shlex.split(query)
+        except ValueError as e:
+            if not fielded(query.split()):
+                # a playlist name such as "Nope's"
+                return None
+            raise ValueError('invalid query: {0}'.format(e))
+        if not fielded(terms):
+            return None
+        matches = {}
+        for term in terms:
+            field, sep, value = term.partition(':')
+            field = field.lower()
+            if not sep:
+                field, value = '', '*' + term + '*'
+            elif field not in QUERY_FIELDS:
+                raise ValueError('unknown field in query: ' + term)
+            matches.setdefault(field, []).append(
+                value.replace('\\', '\\\\').replace('%', '\\%')
+                .replace('_', '\\_').replace('*', '%'))
+        where = []
+        values = []
+        for field, patterns in sorted(matches.items()):
+            columns = [field] if field else ['artist', 'album', 'title']
+            where.append('(' + ' OR '.join(
+                ["{0} LIKE ? ESCAPE '\\'".format(column)
+                 for column in columns for pattern in patterns]) + ')')
+            values.extend([pattern for column in columns
+                           for pattern in patterns])
+        fileName = os.path.join(CACHE_DIR, LIBRARY_INDEX)
+        if not os.path.isfile(fileName):
+            raise ValueError('no library index, run --indexLibrary first')
+        conn = sqlite3.connect(fileName)
+        try:
+            return conn.execute('SELECT uri, didl FROM tracks WHERE ' +
+                                ' AND '.join(where) +
+                                ' ORDER BY artist, album, track, title',
+                                values).fetchall()
+        finally:
+            conn.close()
+
+
+    def queueTracks(self, speaker, tracks, batchSize, playMode, save):
+        """ Replace the queue with the (uri, didl) tracks, batchSize at a
+            time with their metadata, save it as the playlist save, if
+            given, and start playing. """
+        try:
             speaker.clear_queue()
+        except:
+            # queue must be empty
+            pass
+        for start in range(0, len(tracks), batchSize):
+            batch = tracks[start:start + batchSize]
+            self.addUrisToQueue(speaker, [uri for uri, didl in batch],
+                                [didl for uri, didl in batch])
+        print('{0} tracks queued.'.format(len(tracks)))
+        if save:
+            speaker.create_sonos_playlist_from_queue(save)
+            self.forgetPlaylistIndex(speaker)
+        if 'S' in playMode:
+            idx = random.randint(0, len(tracks) - 1)
+        else:
+            idx = 0
+        try:
+            speaker.play_from_queue(idx)
+        except:
+            print("Error: could not play_from_queue")
+            if self.verbose:
+                traceback.print_exc()
+
+
+    def runJobs(self, func, items, jobs, timeout=None):
+        """ Call func for each item from a pool of at most jobs threads.
+            Returns the results in the order of items; the result of a call
+            that raised is the exception.  Calls still running after timeout
+            seconds are left behind and their result is socket.timeout. """
+        results = [None] * len(items)
+        finished = [False] * len(items)
+        stopped = threading.Event()
+        work = queue.Queue()
+        for idx, item in enumerate(items):
+            work.put((idx, item))
+        # the workers act for the target of this thread (see runTargets)
+        # and their output goes where the output of this thread goes
+        context = dict(self.local.__dict__)
+        output = sys.stdout if isinstance(sys.stdout, ThreadOutput) else None
+        buffer = output.current() if output else None
+
+        def worker():
+            self.local.__dict__.update(context)
+            if buffer is not None:
+                output.capture(buffer)
+            try:
+                while not stopped.is_set():
+                    try:
+                        idx, item = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results[idx] = func(item)
+                    except Exception as e:
+                        if self.verbose:
+                            traceback.print_exc()
+                        results[idx] = e
+                    finished[idx] = True
+            finally:
+                # its connections are kept for the next workers
+                soco.services.requests.release()
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(max(1, min(jobs, len(items))))]
+        for thread in threads:
+            # a hung speaker must not keep the process alive
+            thread.daemon = True
+            thread.start()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for thread in threads:
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.time()))
+        stopped.set()
+        return [result if done else socket.timeout('timed out')
+                for result, done in zip(results, finished)]
+
+
+    def uriMetadata(self, uri, didl=None):
+        """ Return the DIDL-Lite to send with the URI: didl from the export,
+            or else a bare item like add_uri_to_queue, which leaves the
+            speaker to look the track up. """
+        if didl:
+            return didl
+        ds = soco.data_structures
+        res = [ds.DidlResource(uri=uri, protocol_info='x-rincon-playlist:*:*:*')]
+        return ds.to_didl_string(ds.DidlObject(resources=res, title='',
+                                               parent_id='', item_id=''))
+
+
+    def syncPl(self, speaker, pl, uris, didls):
+        """ Edit the saved playlist pl in place so it holds the uris, with
+            the metadata in didls (None when unknown).  Only the differences
+            are sent: one call removes the extra tracks, one call per missing
+            track inserts it in place and one call per misplaced track moves
+            it. """
+        metadata = dict(zip(uris, didls))
+        current = []
+        updateId = None
+        for page in self.browsePages(speaker, pl):
+            if updateId is None:
+                updateId = page.update_id
+            current.extend([item.resources[0].uri for item in page])
+        if updateId is None:
+            # empty playlist
+            updateId = soco.music_library.MusicLibrary(speaker).browse(
+                pl, start=0, max_items=1).update_id
+
+        # remove the tracks that are not wanted, or wanted fewer times
+        wanted = {}
+        for uri in uris:
+            wanted[uri] = wanted.get(uri, 0) + 1
+        kept = []
+        removed = []
+        for idx, uri in enumerate(current):
+            if wanted.get(uri, 0) > 0:
+                wanted[uri] -= 1
+                kept.append(uri)
+            else:
+                removed.append(str(idx))
+        if removed:
+            response = speaker.avTransport.ReorderTracksInSavedQueue([
+                ('InstanceID', 0),
+                ('ObjectID', pl.item_id),
+                ('UpdateID', updateId),
+                ('TrackList', ','.join(removed)),
+                ('NewPositionList', '')
+            ])
+            updateId = int(response['NewUpdateID'])
+
+        # rank each track by its position in uris
+        positions = {}
+        for idx, uri in enumerate(uris):
+            positions.setdefault(uri, []).append(idx)
+        ranks = [positions[uri].pop(0) for uri in kept]
+        missing = sorted([(rank, uri) for uri, left in positions.items()
+                          for rank in left])
+
+        # insert each missing track right after its predecessor among the
+        # tracks already in order, so it needs no move afterwards
+        ordered = sorted([ranks[idx] for idx in longestIncreasing(ranks)])
+        for rank, uri in missing:
+            pos = bisect.bisect_left(ordered, rank)
+            new = ranks.index(ordered[pos - 1]) + 1 if pos else 0
+            response = speaker.avTransport.AddURIToSavedQueue([
+                ('InstanceID', 0),
+                ('UpdateID', updateId),
+                ('ObjectID', pl.item_id),
+                ('EnqueuedURI', uri),
+                ('EnqueuedURIMetaData', self.uriMetadata(uri, metadata[uri])),
+                ('AddAtIndex', new if new < len(ranks) else 4294967295)
+            ])
+            updateId = int(response['NewUpdateID'])
+            ranks.insert(new, rank)
+            ordered.insert(pos, rank)
+        added = len(missing)
+
+        # move every track outside the longest run already in order next to
+        # its predecessor
+        inOrder = longestIncreasing(ranks)
+        moved = 0
+        for rank in sorted([r for i, r in enumerate(ranks) if i not in inOrder]):
+            old = ranks.index(rank)
+            if rank == 0:
+                new = 0
+            else:
+                new = ranks.index(rank - 1)
+                if old > new:
+                    new += 1
+            ranks.insert(new, ranks.pop(old))
+            if old == new:
+                continue
+            response = speaker.avTransport.ReorderTracksInSavedQueue([
+                ('InstanceID', 0),
+                ('ObjectID', pl.item_id),
+                ('UpdateID', updateId),
+                ('TrackList', str(old)),
+                ('NewPositionList', str(new))
+            ])
+            updateId = int(response['NewUpdateID'])
+            moved += 1
+        print('%s: %d removed, %d added, %d moved' %
+              (pl.title, len(removed), added, moved))
+
+
+    def addUrisToQueue(self, speaker, uris, didls):
+        """ Add the URIs, with the metadata in didls (None when unknown),
+            to the end of the queue with one AddMultipleURIsToQueue call per
+            MAX_URIS.  Falls back to adding the URIs one at a time if the
+            speaker rejects a call. """
+        if len(uris) > MAX_URIS:
+            for start in range(0, len(uris), MAX_URIS):
+                self.addUrisToQueue(speaker, uris[start:start + MAX_URIS],
+                                    didls[start:start + MAX_URIS])
+            return
+        metadata = [self.uriMetadata(uri, didl)
+                    for uri, didl in zip(uris, didls)]
+        # the URIs are space separated so they can't contain a space
+        if len(uris) > 1 and not [uri for uri in uris if ' ' in uri]:
+            try:
+                speaker.avTransport.AddMultipleURIsToQueue([
+                    ('InstanceID', 0),
+                    ('UpdateID', 0),
+                    ('NumberOfURIs', len(uris)),
+                    ('EnqueuedURIs', ' '.join(uris)),
+                    ('EnqueuedURIsMetaData', ' '.join(metadata)),
+                    ('ContainerURI', ''),
+                    ('ContainerMetaData', ''),
+                    ('DesiredFirstTrackNumberEnqueued', 0),
+                    ('EnqueueAsNext', 0)
+                ])
+                return
+            except soco.exceptions.SoCoUPnPException:
+                if self.verbose:
+                    traceback.print_exc()
+        for uri, didl in zip(uris, metadata):
+            speaker.avTransport.AddURIToQueue([
+                ('InstanceID', 0),
+                ('EnqueuedURI', uri),
+                ('EnqueuedURIMetaData', didl),
+                ('DesiredFirstTrackNumberEnqueued', 0),
+                ('EnqueueAsNext', 0)
+            ])
+
+
+    def loadCheckpoint(self):
+        """ Return the checkpoint of an unfinished import, or None. """
+        try:
+            with open(os.path.join(CACHE_DIR, CHECKPOINT), 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def saveCheckpoint(self, checkpoint):
+        """ Save the import checkpoint.  It is written under a temporary
+            name and renamed so an interrupt never leaves half a file. """
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        saveJson(os.path.join(CACHE_DIR, CHECKPOINT), checkpoint)
+
+
+    def clearCheckpoint(self):
+        """ Remove the checkpoint of a finished import. """
+        fileName = os.path.join(CACHE_DIR, CHECKPOINT)
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+
+
+    def importFiles(self, speaker, fileNames, batchSize, sync, resume):
+        """ Import the files as a job list.  Progress is saved in a
+            checkpoint after every batch the speaker confirms, so an import
+            that fails or is interrupted continues where it stopped when run
+            again with resume.  Returns False if the import stopped. """
+        if resume:
+            checkpoint = self.loadCheckpoint()
+            if checkpoint is None:
+                print('Error: no import to resume.')
+                return False
+            if checkpoint['done'] < len(checkpoint['files']):
+                print('Resuming import of {0} after {1} tracks.'.format(
+                      checkpoint['files'][checkpoint['done']],
+                      checkpoint['confirmed']))
+        else:
+            checkpoint = {'files': [os.path.abspath(fileName)
+                                    for fileName in fileNames],
+                          'speaker': speaker.ip_address, 'sync': sync,
+                          'done': 0, 'playlist': None, 'confirmed': 0,
+                          'batchSize': batchSize}
+        try:
+            while checkpoint['done'] < len(checkpoint['files']):
+                fileName = checkpoint['files'][checkpoint['done']]
+                self.saveCheckpoint(checkpoint)
+                if not self.importPl(speaker, fileName, batchSize,
+                                     checkpoint['sync'], checkpoint):
+                    print('Error: import of {0} stopped after {1} tracks.'
+                          '  Use --resume to continue.'.format(
+                          fileName, checkpoint['confirmed']))
+                    return False
+                checkpoint['done'] += 1
+                checkpoint['playlist'] = None
+                checkpoint['confirmed'] = 0
+        except KeyboardInterrupt:
+            print('')
+            print('Import of {0} interrupted after {1} tracks.  Use --resume'
+                  ' to continue.'.format(fileName, checkpoint['confirmed']))
+            exit(1)
+        self.clearCheckpoint()
+        return True
+
+
+    def resumePoint(self, speaker, reader, fileName, confirmed, batchSize):
+        """ Return the number of tracks of the file that are already in the
+            queue, or 0 if the queue no longer matches the checkpoint.  A
+            batch sent just before a failure may have been added without
+            being confirmed, so the queue can be up to a batch longer. """
+        queued = speaker.queue_size
+        if queued < confirmed or queued > confirmed + batchSize or not queued:
+            return 0
+        last = speaker.get_queue(start=queued - 1, max_items=1)
+        if not last:
+            return 0
+        with open(fileName, 'rb') as raw:
+            fp = gzip.GzipFile(fileobj=raw) \
+                 if fileName.lower().endswith('.gz') else raw
+            idx = 0
+            for tag, value in reader(fp, fileName):
+                if tag != 'location':
+                    continue
+                idx += 1
+                if idx == queued:
+                    if value == last[0].resources[0].uri:
+                        return queued
+                    break
+        return 0
+
+
+    def importPl(self, speaker, fileName, batchSize, sync, checkpoint=None):
+        """ Import playlist from file to speaker.  The format is from the
+            file name suffix and the file is read as a stream.  With sync an
+            existing playlist is edited to match the file.  Returns False if
+            the speaker failed part way, so the import can be resumed from
+            the checkpoint. """
+        reader = FORMATS[fileFormat(fileName)][1]
+        try:
+            raw = open(fileName, 'rb')
+        except (IOError, OSError) as e:
+            print("Error: file {0}: {1}".format(fileName, e.strerror))
+            return True
+        try:
+            with raw:
+                if checkpoint and checkpoint['confirmed'] and not sync:
+                    # the batch that may be unconfirmed is from the run that
+                    # saved the checkpoint
+                    skip = self.resumePoint(speaker, reader, fileName,
+                                            checkpoint['confirmed'],
+                                            checkpoint.get('batchSize',
+                                                           batchSize))
+                    if not skip:
+                        print('Warning: the queue changed, importing {0} from'
+                              ' the start.'.format(fileName))
+                    checkpoint['confirmed'] = skip
+                if checkpoint and checkpoint.get('batchSize') != batchSize:
+                    checkpoint['batchSize'] = batchSize
+                    self.saveCheckpoint(checkpoint)
+                fp = gzip.GzipFile(fileobj=raw) \
+                     if fileName.lower().endswith('.gz') else raw
+                self.importRecords(speaker, reader(fp, fileName), fileName,
+                                   batchSize, sync, checkpoint)
         except ET.ParseError:
             print('Error: invalid XML format.')
             if self.verbose:
                 traceback.print_exc()
+        except ValueError as e:
+            print('Error: {0}'.format(e))
+            if self.verbose:
+                traceback.print_exc()
+        except Exception as e:
+            print('Error: {0}'.format(e))
+            if self.verbose:
+                traceback.print_exc()
+            return False
+        return True
+
+
+    def importRecords(self, speaker, records, source, batchSize, sync,
+                      checkpoint=None):
+        """ Import a playlist from the ('title', title), ('location', uri)
+            and ('metadata', didl) records of a reader.  source names the
+            records in errors.  The tracks confirmed by the checkpoint are
+            already in the queue and are skipped; every batch added is
+            recorded in it. """
+        plName = None
+        skip = checkpoint['confirmed'] if checkpoint else 0
+        firstTrack = not skip
+        uris = []
+        didls = []
+        existing = None
+        # the metadata record follows the location it belongs to
+        described = False
+
+        for tag, value in records:
+            if tag == 'title':
+                if plName is not None:
+                    continue
+                plName = value
+                if checkpoint is not None:
+                    checkpoint['playlist'] = plName
+                existing = self.findPlaylist(self.playlistIndex(speaker),
+                                             plName)
+                if existing and not sync:
+                    print('Error: Sonos playlist "%s" already exists.  The'
+                          ' playlist must be deleted before importing or use'
+                          ' --sync.' % plName)
+                    return
+                continue
+            if plName is None:
+                print('Error: no playlist title before the tracks in: '
+                      + source)
+                return
+            if tag == 'metadata':
+                if described:
+                    didls[-1] = value
+                continue
+            described = False
+            if skip:
+                skip -= 1
+                continue
+            if not existing:
+                if firstTrack:
+                    speaker.clear_queue()
+                    firstTrack = False
+                # process the tracks a batch at a time, once the metadata of
+                # the last one is read
+                if len(uris) >= batchSize:
+                    self.addUrisToQueue(speaker, uris, didls)
+                    self.confirm(checkpoint, len(uris))
+                    uris = []
+                    didls = []
+                    print('.', end='')
+                    sys.stdout.flush()
+            uris.append(value)
+            didls.append(None)
+            described = True
+        if plName is None:
+            print('Error: no playlist title in: ' + source)
             return
-        except IOError as e:
-            print("Error: file {0}: {1}".format(fileName, e.strerror))
+        if existing:
+            self.syncPl(speaker, existing, uris, didls)
+            self.forgetPlaylistIndex(speaker)
             return
+        if firstTrack:
+            speaker.clear_queue()
+        if uris:
+            self.addUrisToQueue(speaker, uris, didls)
+            self.confirm(checkpoint, len(uris))
+            print('.', end='')
+        if not firstTrack:
+            print('')
+        speaker.create_sonos_playlist_from_queue(plName)
+        self.forgetPlaylistIndex(speaker)
+        speaker.clear_queue()
+
+
+    def confirm(self, checkpoint, tracks):
+        """ Record in the checkpoint that the speaker added tracks. """
+        if checkpoint is not None:
+            checkpoint['confirmed'] += tracks
+            self.saveCheckpoint(checkpoint)
+
+
+    def playlistIndex(self, speaker):
+        """ Return the index of the saved playlists of the speaker: the
+            container update ID and, in speaker order, the title, DIDL, track
+            count and update ID of each playlist (the counts are None until
+            known).  The index is kept in ~/.spl and is used as long as the
+            system update ID of the speaker is unchanged, so when nothing
+            changed it costs one call. """
+        ip = speaker.ip_address
+        try:
+            systemId = speaker.contentDirectory.GetSystemUpdateID([])['Id']
+        except:
+            if self.verbose:
+                traceback.print_exc()
+            systemId = None
+        with self.indexLock:
+            if self.plIndex is None:
+                try:
+                    with open(os.path.join(CACHE_DIR, PLAYLIST_INDEX),
+                              'r') as fp:
+                        self.plIndex = json.load(fp)
+                except (IOError, OSError, ValueError):
+                    self.plIndex = {}
+            index = self.plIndex.get(ip)
+        if index is None or systemId is None or \
+           index['systemUpdateId'] != systemId:
+            listing = speaker.get_sonos_playlists(complete_result=True)
+            index = {'systemUpdateId': systemId,
+                     'containerUpdateId': getattr(listing, 'update_id', None),
+                     'playlists': [{'title': pl.title,
+                                    'didl': pl.to_dict(remove_nones=True),
+                                    'tracks': None, 'updateId': None}
+                                   for pl in listing]}
+            with self.indexLock:
+                self.plIndex[ip] = index
+                self.savePlaylistIndex()
+        if 'byTitle' not in index:
+            index['byTitle'] = dict([(entry['title'], entry)
+                                     for entry in index['playlists']])
+        return index
+
+
+    def savePlaylistIndex(self):
+        """ Save the playlist indexes of the speakers. """
+        self.indexLock.acquire()
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            indexes = {}
+            for ip, index in self.plIndex.items():
+                indexes[ip] = dict([(key, index[key]) for key in index
+                                    if key != 'byTitle'])
+            saveJson(os.path.join(CACHE_DIR, PLAYLIST_INDEX), indexes)
+        except:
+            # the index is only an optimization
+            if self.verbose:
+                traceback.print_exc()
+        finally:
+            self.indexLock.release()
+
+
+    def forgetPlaylistIndex(self, speaker):
+        """ Drop the index of the speaker after changing its playlists. """
+        with self.indexLock:
+            if self.plIndex and self.plIndex.pop(speaker.ip_address, None):
+                self.savePlaylistIndex()
+
+
+    def playlistObject(self, entry):
+        """ Return the soco object of a playlist index entry. """
+        # from_dict replaces the resources in the dict it is given
+        return soco.data_structures.DidlPlaylistContainer.from_dict(
+            dict(entry['didl']))
+
+
+    def indexedPlaylists(self, index):
+        """ Return the playlists of the index as soco objects. """
+        return [self.playlistObject(entry) for entry in index['playlists']]
+
+
+    def findPlaylist(self, index, title):
+        """ Return the playlist with the title from the index, or None. """
+        entry = index['byTitle'].get(title)
+        return self.playlistObject(entry) if entry else None
+
+
+    def recordPlaylists(self, index, pls, checks):
+        """ Record the (update ID, track count) results of checkPls in the
+            index. """
+        changed = False
+        for pl, result in zip(pls, checks):
+            entry = index['byTitle'].get(pl.title)
+            if entry is not None and not isinstance(result, Exception):
+                entry['updateId'], entry['tracks'] = result
+                changed = True
+        if changed:
+            self.savePlaylistIndex()
+
+
+    def loadZoneCache(self, ttl):
+        """ Return the cached zones, or None if the cache is missing or
+            older than ttl seconds. """
+        if ttl <= 0:
+            return None
+        try:
+            with open(os.path.join(CACHE_DIR, 'zones.json'), 'r') as fp:
+                cache = json.load(fp)
+            if time.time() - cache['time'] > ttl:
+                return None
+            self.learnCoordinators(cache['zones'])
+            return cache['zones']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+
+    def learnCoordinators(self, zones):
+        """ Tell the transport the coordinator of each cached zone, so the
+            reads a member does not answer go to its coordinator. """
+        ips = dict((zone['uuid'], zone['ip']) for zone in zones)
+        soco.services.requests.coordinators.update(
+            (zone['ip'], ips[zone['coordinator']]) for zone in zones
+            if zone.get('coordinator') in ips)
+
+
+    def saveZoneCache(self, zones):
+        """ Save name, IP, UUID and group topology of the zones.  The
+            topology is read once per household. """
+        cache = {'time': time.time(), 'zones': []}
+        try:
+            groups = {}
+            for zone in sorted(zones, key=lambda dev: dev.player_name):
+                if zone.uid not in groups:
+                    for group in zone.all_groups:
+                        for member in group.members:
+                            groups[member.uid] = group
+                group = groups.get(zone.uid)
+                cache['zones'].append({
+                    'name': zone.player_name,
+                    'ip': zone.ip_address,
+                    'uuid': zone.uid,
+                    'group': group.uid if group else None,
+                    'coordinator': group.coordinator.uid if group else None})
+            self.learnCoordinators(cache['zones'])
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            saveJson(os.path.join(CACHE_DIR, 'zones.json'), cache)
+        except:
+            # the cache is only an optimization
+            if self.verbose:
+                traceback.print_exc()
+
+
+    def refreshZoneCache(self, ttl):
+        """ Refresh a stale zone cache from the group topology of cached
+            speakers, which is much faster than discovery.  The topology of
+            each household comes from one of its speakers.  Returns True if
+            the cache was refreshed. """
+        if ttl <= 0:
+            return False
+        zones = []
+        seen = set()
+        failures = 0
+        for zone in self.loadZoneCache(float('inf')) or []:
+            if zone['ip'] in seen:
+                continue
+            try:
+                soco.core.zone_group_state_shared_cache.clear()
+                found = soco.SoCo(zone['ip']).visible_zones
+            except:
+                failures += 1
+                if failures == 3:
+                    break
+                continue
+            for member in found:
+                if member.ip_address not in seen:
+                    seen.add(member.ip_address)
+                    zones.append(member)
+        if zones:
+            self.saveZoneCache(zones)
+            return True
+        return False
+
+
+    def discoverHouseholds(self, interface, timeout=1.0):
+        """ Discover the zones of every household.  soco.discover stops at
+            the first speaker that answers, so the answers are collected for
+            timeout seconds and the topologies of the households are read
+            from one speaker each, at the same time. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        if interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                            socket.inet_aton(interface))
+        search = ('M-SEARCH * HTTP/1.1\r\n'
+                  'HOST: 239.255.255.250:1900\r\n'
+                  'MAN: "ssdp:discover"\r\n'
+                  'MX: 1\r\n'
+                  'ST: urn:schemas-upnp-org:device:ZonePlayer:1\r\n'
+                  '\r\n').encode('ascii')
+        households = {}
+        start = time.time()
+        try:
+            for i in range(3):
+                sock.sendto(search, ('239.255.255.250', 1900))
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                sock.settimeout(max(0.01, deadline - time.time()))
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    break
+                if b'Sonos' not in data:
+                    continue
+                household = addr[0]
+                for line in data.decode('utf-8', 'replace').split('\r\n'):
+                    if line.upper().startswith('X-RINCON-HOUSEHOLD:'):
+                        household = line.split(':', 1)[1].strip()
+                households.setdefault(household, addr[0])
+        except socket.error:
+            if self.verbose:
+                traceback.print_exc()
+        finally:
+            sock.close()
+        metrics.record('discover', 'M-SEARCH', interface or 'multicast',
+                       time.time() - start, 0,
+                       'ok' if households else 'none')
+        ips = sorted(households.values())
+        zones = []
+        seen = set()
+        for found in self.runJobs(lambda ip: soco.SoCo(ip).visible_zones,
+                                  ips, len(ips), timeout * 5):
+            if isinstance(found, Exception):
+                continue
+            for zone in found:
+                if zone.ip_address not in seen:
+                    seen.add(zone.ip_address)
+                    zones.append(zone)
+        return zones
+
+
+    def discoverZones(self, interface):
+        """ Discover the zones with SSDP multicast. """
+        start = time.time()
+        if interface:
+            try:
+                zones = soco.discover(interface_addr=interface)
+            except:
+                print('Error: invalid interface address: ' + interface)
+                if self.verbose:
+                    traceback.print_exc()
+                exit(-2)
+        else:
+            zones = soco.discover()
+        metrics.record('discover', 'M-SEARCH', interface or 'multicast',
+                       time.time() - start, 0, 'ok' if zones else 'none')
+        if not zones:
+            print('Error: discover returned no speakers.')
+            if interface:
+                print(' Either the interface is down or you have no Sonos'
+                      ' speakers on the network.')
+            else:
+                print(' Either the interface is down, you have no Sonos'
+                      ' speakers on the network, or you may\n need to use -I'
+                      ' option.')
+            exit(-2)
+        self.saveZoneCache(zones)
+        return zones
+
+
+    def cachedSpeaker(self, name, ttl):
+        """ Build the speaker directly from an IP address or the zone cache.
+            Returns the speaker and its selection, or (None, '') when
+            discovery is needed. No network calls are made. """
+        if name:
+            try:
+                return soco.SoCo(name), 'specific'
+            except ValueError:
+                # not an IP address, try the cache
+                pass
+        zones = self.loadZoneCache(ttl)
+        if not zones:
+            return None, ''
+        for zone in zones:
+            if not name:
+                return soco.SoCo(zone['ip']), 'random'
+            if zone['name'] == name:
+                return soco.SoCo(zone['ip']), 'specific'
+        return None, ''
+
+
+    def findSpeaker(self, name, interface, ttl):
+        """ Select the speaker, discovering only when the IP address or the
+            zone cache does not give a responding speaker.
+            Returns the speaker, the selection and the visible zones. """
+        speaker, speakerSelection = self.cachedSpeaker(name, ttl)
+        if not speaker and self.refreshZoneCache(ttl):
+            speaker, speakerSelection = self.cachedSpeaker(name, ttl)
+        if speaker:
+            try:
+                # the group topology is needed anyway and shows the
+                # speaker responds and still has the expected name
+                if speaker.group and (not name or \
+                   name in (speaker.ip_address, speaker.player_name)):
+                    return speaker, speakerSelection, speaker.visible_zones
+            except:
+                if self.verbose:
+                    traceback.print_exc()
+            if self.verbose:
+                print('Cached speaker did not respond, discovering.')
+
+        speaker = None
+        zones = self.discoverZones(interface)
+        speakerSelection = ''
+        try:
+            if name:
+                for zone in zones:
+                    if zone.ip_address == name or \
+                       zone.player_name == name:
+                        speaker = zone
+                        speakerSelection = 'specific'
+                        break
+            else:
+                for zone in zones:
+                    speaker = zone
+                    speakerSelection = 'random'
+                    break
         except:
+            print('Error: could not discover any speakers.')
+            if self.verbose:
+                traceback.print_exc()
+            exit(-2)
+        if not speaker:
+            print('Error: unable to find speaker.')
+            exit(-1)
+        return speaker, speakerSelection, zones
+
+
+    def findTargets(self, names, allCoordinators, interface, ttl, timeout):
+        """ Select the groups of the speakers matching the names (IP
+            addresses, names or patterns such as 'Kitchen*'), or every group
+            with allCoordinators, in every household.  IP addresses are used
+            directly; the rest come from the zone cache or discovery.  The
+            groups are read from the speakers at the same time.  Returns the
+            (coordinator, group, household) of each selected group once,
+            where household is the same for the groups of one household,
+            and whether a speaker failed.  Exits if a name matches no
+            speaker. """
+        def select(zones):
+            if allCoordinators:
+                return [zone for zone in zones
+                        if zone['uuid'] == zone['coordinator']], []
+            selected = []
+            missing = []
+            for name in patterns:
+                found = [zone for zone in zones
+                         if name in (zone['ip'], zone['name']) or
+                         fnmatch.fnmatchcase(zone['name'], name)]
+                if not found:
+                    missing.append(name)
+                selected += [zone for zone in found if zone not in selected]
+            return selected, missing
+
+        ips = []
+        patterns = []
+        for name in names or []:
+            try:
+                soco.SoCo(name)
+                ips.append(name)
+            except ValueError:
+                # not an IP address
+                patterns.append(name)
+        selected = []
+        missing = []
+        if allCoordinators or patterns:
+            zones = self.loadZoneCache(ttl)
+            if not zones and self.refreshZoneCache(ttl):
+                zones = self.loadZoneCache(ttl)
+            selected, missing = select(zones or [])
+            if not zones or missing:
+                if self.verbose:
+                    print('Discovering every household.')
+                found = self.discoverHouseholds(interface)
+                if not found:
+                    print('Error: discover returned no speakers.')
+                    exit(-2)
+                self.saveZoneCache(found)
+                zones = [{'name': zone.player_name, 'ip': zone.ip_address,
+                          'uuid': zone.uid, 'coordinator': None}
+                         for zone in found]
+                if allCoordinators:
+                    # the groups are read below
+                    selected, missing = zones, []
+                else:
+                    selected, missing = select(zones)
+        for name in missing:
+            print('Error: no speaker matches: ' + name)
+        if missing:
+            exit(-1)
+        selected += [{'name': ip, 'ip': ip} for ip in ips
+                     if ip not in [zone['ip'] for zone in selected]]
+
+        def group(speaker):
+            # one topology read gives the group and the household
+            groups = speaker.all_groups
+            household = min([member.uid for group in groups
+                             for member in group.members])
+            return [group for group in groups
+                    if speaker in group.members][0], household
+
+        speakers = [soco.SoCo(zone['ip']) for zone in selected]
+        results = self.runJobs(group, speakers, len(speakers), timeout)
+        targets = []
+        seen = set()
+        failed = False
+        for zone, result in zip(selected, results):
+            if isinstance(result, Exception):
+                print('Error: {0}: {1}'.format(zone['name'], result))
+                failed = True
+                continue
+            group, household = result
+            if group.coordinator.uid not in seen:
+                seen.add(group.coordinator.uid)
+                targets.append((group.coordinator, group, household))
+        if not targets:
+            exit(-1)
+        return sorted(targets, key=lambda target: target[0].player_name), \
+               failed
+
+
+    def runTargets(self, args, targets, playMode, jobs, failed=False):
+        """ Run the actions on every target group at the same time.  The
+            output of each target is printed in target order with the name
+            of its coordinator in front of each line.  The saved playlists
+            belong to the household, so -l and exports run on the first
+            target of each household only, and its exports go in a
+            directory named after its coordinator.  Exits with the first
+            nonzero exit code, or -1 if another speaker failed. """
+        # a server already captures the output of each thread
+        shared = isinstance(sys.stdout, ThreadOutput)
+        output = sys.stdout if shared else ThreadOutput(sys.stdout)
+        base = getattr(self.local, 'directory', '')
+        # the first action given is the one that runs, see actions
+        if args.listPlaylist or \
+           ((args.exportPlaylist or args.exportAllPlaylists) and
+            not (args.listSpeakerInfo or args.togglePausePlay or args.pause)):
+            households = set()
+            for target in list(targets):
+                if target[2] in households:
+                    targets.remove(target)
+                households.add(target[2])
+
+        def run(target):
+            coordinator, group, household = target
+            output.capture()
+            code = 0
+            try:
+                if args.exportPlaylist or args.exportAllPlaylists:
+                    directory = os.path.join(base, coordinator.player_name
+                                             .replace('/', '_')
+                                             .replace('\\', '_'))
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    self.local.directory = directory
+                members = list(group.members)
+                self.actions(args, coordinator,
+                             'party' if len(members) > 1 else 'specific',
+                             coordinator, members, playMode, jobs)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    code = e.code
+                elif e.code is not None:
+                    print(e.code)
+                    code = 1
+            except Exception as e:
+                print('Error: {0}'.format(e))
+                if self.verbose:
+                    print(traceback.format_exc())
+                code = -1
+            finally:
+                self.local.directory = base
+            return code, output.release()
+
+        if not shared:
+            sys.stdout = output
+        try:
+            results = self.runJobs(run, targets, len(targets))
+        finally:
+            if not shared:
+                sys.stdout = output.stream
+        code = 0
+        for (coordinator, group, household), (result, text) in \
+                zip(targets, results):
+            for line in text.splitlines():
+                print('{0}: {1}'.format(coordinator.player_name, line))
+            code = code or result
+        exit(code or (-1 if failed else 0))
+
+
+    def forward(self, socketPath, argv):
+        """ Send the command line to the spl server and exit with its
+            output and exit code. """
+        request = {'argv': [arg for arg in argv if arg != '--client'],
+                   'cwd': os.getcwd()}
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socketPath)
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            fp = sock.makefile('rb')
+            response = json.loads(fp.readline().decode('utf-8'))
+            sock.close()
+        except (socket.error, ValueError) as e:
+            print('Error: cannot reach the spl server at %s: %s' %
+                  (socketPath, e))
+            exit(-2)
+        sys.stdout.write(response['output'])
+        sys.stdout.flush()
+        exit(response['code'])
+
+
+    def serveRequest(self, argv, cwd):
+        """ Run one forwarded command line on the thread of the request.
+            The output of the thread is captured by the ThreadOutput of
+            serve.  Requests run at the same time, so the directory of the
+            client is not changed to; its file names are taken relative to
+            it instead.  Returns the output and exit code. """
+        output = sys.stdout
+        output.capture()
+        code = 0
+        try:
+            # exports go in the directory of the client, see exportPath
+            self.local.directory = cwd
+            args = self.parser.parse_args(argv)
+            if args.serve or args.client or args.watch:
+                print('Error: --serve, --client and --watch can not be'
+                      ' forwarded.')
+                exit(-2)
+            if args.importPlaylistFile:
+                args.importPlaylistFile = [os.path.join(cwd, fileName)
+                                           for fileName in
+                                           args.importPlaylistFile]
+            if args.restore:
+                args.restore = os.path.join(cwd, args.restore)
+            if args.metricsJson and args.metricsJson != '-':
+                args.metricsJson = os.path.join(cwd, args.metricsJson)
+            self.measure(args)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                print(e.code)
+                code = 1
+        except Exception:
             traceback.print_exc()
+            code = -1
+        finally:
+            self.local.directory = ''
+        return output.release(), code
 
 
-    def __init__(self):
+    def serve(self, socketPath):
+        """ Run the actions of forwarded command lines until interrupted,
+            each on its own thread so a long export or import does not hold
+            up a volume change.  Zones, group topology and HTTP sessions stay
+            warm between requests. """
+        spl = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                try:
+                    output, code = spl.serveRequest(request['argv'],
+                                                    request['cwd'])
+                finally:
+                    soco.services.requests.release()
+                response = json.dumps({'output': output, 'code': code})
+                self.wfile.write((response + '\n').encode('utf-8'))
+
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        elif not os.path.isdir(os.path.dirname(socketPath)):
+            os.makedirs(os.path.dirname(socketPath))
+        server = socketserver.ThreadingUnixStreamServer(socketPath, Handler)
+        server.daemon_threads = True
+        os.chmod(socketPath, 0o600)
+        print('Serving on ' + socketPath)
+        sys.stdout.flush()
+        sys.stdout = sys.stderr = ThreadOutput(sys.stdout)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(socketPath)
+        exit(0)
+
+
+    def __init__(self, argv=None):
         """ Process the command line arguments. """
 
-        parser = argparse.ArgumentParser(description='''
+        self.parser = parser = argparse.ArgumentParser(description='''
 Utility for Sonos playlists including backup and restore.
-The backup file is XSPF format and is stored in the current directory.  For
-import, the name of the playlist is stored in the XSPF file, it is not the
-name of the file.
+The backup file is XSPF format (or the format of -F) and is stored in the
+current directory.  For import, the name of the playlist is stored in the
+file, it is not the name of the file.
 ''')
         parser.add_argument('-l', '--listPlaylist', action='store_true',
                             help='List the playlists.')
@@ -242,30 +2636,98 @@ name of the file.
                             help='Verbose error messages.')
         parser.add_argument('-S', '--listSpeakerInfo', action='store_true',
                             help='List information about the speakers.')
+        parser.add_argument('--json', action='store_true',
+                            help='List the speaker information as JSON.')
+        parser.add_argument('--timeout', type=float, default=5,
+                            help='Seconds to wait for each speaker when'
+                            ' listing information or changing a group.'
+                            '  Default is 5.',
+                            metavar='SECONDS')
+        parser.add_argument('--callTimeout', type=float,
+                            help='Seconds to wait for the answer to a call to'
+                            ' a speaker.  Default is %d, %d when browsing and'
+                            ' %d when changing the queue.'
+                            % (CALL_TIMEOUT, CALL_TIMEOUTS['browse'],
+                               CALL_TIMEOUTS['queue']),
+                            metavar='SECONDS')
+        parser.add_argument('--retries', type=int, default=RETRIES,
+                            help='Number of times a read that failed is sent'
+                            ' again, to the group coordinator when known.'
+                            '  Default is %d.' % RETRIES, metavar='N')
         parser.add_argument('-x', '--exportPlaylist', action='append',
                             help='Export the playlist.', metavar='PLAYLIST')
         parser.add_argument('-X', '--exportAllPlaylists', action='store_true',
                             help='Export all playlists.')
         parser.add_argument('-d', '--exportDetails', default='ACLT',
                             help='List specifying what information is in the'
-                            ' export file.  Possible values are ACLT.'
-                            ' A = album, C = creator, L = location, T = title.'
+                            ' export file.  Possible values are ACLMT.'
+                            ' A = album, C = creator, L = location,'
+                            ' M = metadata for import, T = title.'
                             ' Default is ACLT.',
                             metavar='DETAILS')
+        parser.add_argument('-F', '--format', default='xspf',
+                            choices=sorted(FORMATS),
+                            help='Format of the export files.  Import uses'
+                            ' the suffix of the file name.  Default is'
+                            ' xspf.')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of playlists exported at the same'
+                            ' time (1-%d).  Default is 1.' % MAX_JOBS,
+                            metavar='N')
+        parser.add_argument('-u', '--incremental', action='store_true',
+                            help='Only export playlists that changed since'
+                            ' the last incremental export.  Changes are'
+                            ' tracked in %s.' % MANIFEST)
+        parser.add_argument('--archive', metavar='FILE',
+                            help='Export into one SQLite archive file that'
+                            ' stores each distinct track once, instead of a'
+                            ' file per playlist.')
         parser.add_argument('-f', '--force', action='store_true',
                             help='Force overwrite of export files.')
         parser.add_argument('-i', '--importPlaylistFile', action='append',
                             help='Import the playlist file.', metavar='FILE')
-        parser.add_argument('-s', '--speaker',
-                            help='Speaker name or IP address.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue the import that failed or was'
+                            ' interrupted, from the last track the speaker'
+                            ' confirmed.')
+        parser.add_argument('--restore', metavar='FILE',
+                            help='Import the playlists of the archive file.')
+        parser.add_argument('--restorePlaylist', action='append',
+                            help='Only import this playlist of the archive.',
+                            metavar='PLAYLIST')
+        parser.add_argument('-y', '--sync', action='store_true',
+                            help='Import into an existing playlist by'
+                            ' changing only the tracks that differ.')
+        parser.add_argument('-b', '--batchSize', type=int, default=16,
+                            help='Number of tracks added to the speaker at a'
+                            ' time when importing, in calls of at most %d.'
+                            '  Default is 16.' % MAX_URIS,
+                            metavar='TRACKS')
+        parser.add_argument('-s', '--speaker', action='append',
+                            help='Speaker name or IP address.  Names may be'
+                            ' patterns such as "Kitchen*".  With more than'
+                            ' one speaker the actions run on the group of'
+                            ' each at the same time.')
+        parser.add_argument('--allCoordinators', action='store_true',
+                            help='Run the actions on every group of every'
+                            ' household at the same time.')
         parser.add_argument('-P', '--partyModeOn', action='store_true',
                             help='Use all speakers.  Must be used with -s to'
                             ' designate the group coordinator.')
         parser.add_argument('-p', '--partyModeOff', action='store_true',
                             help='Stop party mode.')
         parser.add_argument('-q', '--replaceQueue', metavar='PLAYLIST',
-                            help='Replace queue with playlist.  Speakers must'
+                            help='Replace queue with playlist, or with the'
+                            ' tracks of the library index that match a query'
+                            ' such as "artist:Adele genre:Pop".  Speakers must'
                             ' be in party mode or option -s is required.')
+        parser.add_argument('--indexLibrary', action='store_true',
+                            help='Index the tracks of the music library in'
+                            ' ~/.spl/%s for -q queries.  Only the changes are'
+                            ' read again.' % LIBRARY_INDEX)
+        parser.add_argument('--savePlaylist', metavar='PLAYLIST',
+                            help='Save the queue of a -q query as the'
+                            ' playlist.')
         parser.add_argument('-m', '--playMode', default='SRf',
                         help='Play mode: SRF, S = shuffle on, R = repeat on,'
                             ' F = cross fade on.  Lower case is off.  Default'
@@ -274,114 +2736,175 @@ name of the file.
                             help='Volume (0-100). +/- to increase/decrease.')
         parser.add_argument('-t', '--togglePausePlay', action='store_true',
                             help='Toggle pause/play.')
+        parser.add_argument('--pause', action='store_true',
+                            help='Pause the speaker if it is playing.')
+        parser.add_argument('--profile', action='store_true',
+                            help='Print the calls, errors and latency'
+                            ' histogram of each phase, action and speaker'
+                            ' when done.')
+        parser.add_argument('--metricsJson', metavar='FILE',
+                            help='Write the --profile numbers as JSON to the'
+                            ' file, - for standard output.')
         parser.add_argument('-I', '--interface',
                             help='Interface address for discover (generally'
                             ' not needed).')
-        args = parser.parse_args()
+        parser.add_argument('-T', '--cacheTtl', type=int, default=3600,
+                            help='Seconds the zone cache is used before'
+                            ' discovering again.  0 disables the cache.'
+                            ' Default is 3600.', metavar='SECONDS')
+        parser.add_argument('--serve', action='store_true',
+                            help='Run as a server that runs the actions of'
+                            ' --client command lines.')
+        parser.add_argument('--watch', action='store_true',
+                            help='Print speaker changes as lines of JSON.'
+                            '  With --serve, answer -S from the changes.')
+        parser.add_argument('--client', action='store_true',
+                            help='Send the command line to the server.')
+        parser.add_argument('--socket',
+                            default=os.path.join(CACHE_DIR, 'spl.sock'),
+                            help='Socket of the server.  Default is'
+                            ' ~/.spl/spl.sock.', metavar='PATH')
+        args = parser.parse_args(argv)
+        self.verbose = args.verbose
+        self.state = {}
+        self.stateLock = threading.Lock()
+        self.plIndex = None
+        self.indexLock = threading.RLock()
+        self.local = threading.local()
+        # runs that replaced soco's shared topology cache (see run)
+        self.cacheLock = threading.Lock()
+        self.uncached = 0
+        if args.client:
+            self.forward(args.socket, sys.argv[1:] if argv is None else argv)
+
+        global soco
+        import soco
+        if not isinstance(soco.services.requests, SoapTransport):
+            soco.services.requests = SoapTransport(soco.services.requests)
+            soco.core.requests = soco.services.requests
+        if args.serve:
+            if args.watch:
+                speaker, speakerSelection, zones = self.findSpeaker(
+                    args.speaker[0] if args.speaker else None,
+                    args.interface, args.cacheTtl)
+                self.watch(zones, False)
+            self.serve(args.socket)
+        self.measure(args)
+
+
+    def measure(self, args):
+        """ Run the actions, then report the calls they made for --profile
+            and --metricsJson. """
+        metrics.reset()
+        try:
+            self.run(args)
+        finally:
+            if args.profile:
+                metrics.report()
+            if args.metricsJson:
+                metrics.save(args.metricsJson)
+
+
+    def run(self, args):
+        """ Run the actions of the command line arguments. """
         if args.playMode:
             playMode = args.playMode
         else:
             playMode = 'SRf'
         self.verbose = args.verbose
+        soco.services.requests.configure(args.callTimeout, args.retries)
+        jobs = args.jobs
+        if jobs < 1:
+            print('Warning: too few jobs, using 1')
+            jobs = 1
+        elif jobs > MAX_JOBS:
+            print('Warning: too many jobs, using %d' % MAX_JOBS)
+            jobs = MAX_JOBS
+        if args.batchSize < 1:
+            print('Error: the batch size (-b) must be at least 1.')
+            exit(-2)
 
         if self.verbose:
             print('SoCo version: ' + soco.__version__)
 
-        # what speaker are we working with?
-        speaker = None
-        if args.interface:
-            try:
-                zones = soco.discover(interface_addr=args.interface)
-            except:
-                print('Error: invalid interface address: ' + args.interface)
-                if self.verbose:
-                    traceback.print_exc()
+        # resume on the speaker of the checkpoint
+        if args.resume:
+            checkpoint = self.loadCheckpoint()
+            if checkpoint is None:
+                print('Error: no import to resume.')
                 exit(-2)
-        else:
-            zones = soco.discover()
-        if not zones:
-            print('Error: discover returned no speakers.')
-            if args.interface:
-                print(' Either the interface is down or you have no Sonos'
-                      ' speakers on the network.')
-            else:
-                print(' Either the interface is down, you have no Sonos'
-                      ' speakers on the network, or you may\n need to use -I'
-                      ' option.')
-            exit(-2)
-        speakerSelection = ''
-        try:
-            if args.speaker:
-                for zone in zones:
-                    if zone.ip_address == args.speaker or \
-                       zone.player_name == args.speaker:
-                        speaker = zone
-                        speakerSelection = 'specific'
-                        break
-            else:
-                for zone in zones:
-                    speaker = zone
-                    speakerSelection = 'random'
-                    break
-        except:
-            print('Error: could not discover any speakers.')
-            if self.verbose:
-                traceback.print_exc()
-            exit(-2)
-        if not speaker:
-            print('Error: unable to find speaker.')
-            exit(-1)
+            if not args.speaker:
+                args.speaker = [checkpoint['speaker']]
+
+        # several speakers, each group at the same time
+        if args.allCoordinators or len(args.speaker or []) > 1 or \
+           [name for name in args.speaker or []
+            if set('*?[').intersection(name)]:
+            if args.partyModeOn or args.partyModeOff or args.watch or \
+               args.importPlaylistFile or args.resume or args.restore or \
+               args.indexLibrary or args.savePlaylist:
+                print('Error: -P, -p, -i, --resume, --restore, --watch,'
+                      ' --indexLibrary and --savePlaylist need a single'
+                      ' speaker.')
+                exit(-2)
+            # soco shares the topology between speakers, which is wrong
+            # for speakers of different households.  Requests to a server
+            # may run at the same time, the last one done restores it.
+            with self.cacheLock:
+                if not self.uncached:
+                    self.sharedCache = \
+                        soco.services.zone_group_state_shared_cache
+                    soco.services.zone_group_state_shared_cache = \
+                        soco.cache.NullCache()
+                self.uncached += 1
+            try:
+                targets, failed = self.findTargets(args.speaker,
+                                                   args.allCoordinators,
+                                                   args.interface,
+                                                   args.cacheTtl,
+                                                   args.timeout)
+                self.runTargets(args, targets, playMode, jobs, failed)
+            finally:
+                with self.cacheLock:
+                    self.uncached -= 1
+                    if not self.uncached:
+                        soco.services.zone_group_state_shared_cache = \
+                            self.sharedCache
+
+        # what speaker are we working with?
+        speaker, speakerSelection, zones = self.findSpeaker(
+            args.speaker[0] if args.speaker else None, args.interface,
+            args.cacheTtl)
         if len(speaker.group.members) > 1:
             # we are in party mode, use the coordinator
             speakerSelection = 'party'
             cspeaker = speaker.group.coordinator
         else:
             cspeaker = speaker
+        self.actions(args, speaker, speakerSelection, cspeaker, zones,
+                     playMode, jobs)
+
+
+    def actions(self, args, speaker, speakerSelection, cspeaker, zones,
+                playMode, jobs):
+        """ Run the actions of the command line arguments on the speaker.
+            cspeaker is the coordinator of its group and zones the speakers
+            the actions may change. """
+        # stream the changes of the speakers
+        if args.watch:
+            self.watch(zones, True)
+            exit(0)
 
         # list the playlists
         if args.listPlaylist:
-            for pl in cspeaker.get_sonos_playlists():
-                print(pl.title)
+            for entry in self.playlistIndex(cspeaker)['playlists']:
+                print(entry['title'])
             exit(0)
 
         # list info about the speakers
         if args.listSpeakerInfo:
-            for zone in sorted(zones, key=lambda dev: dev.player_name):
-                print(zone.player_name)
-                print('  IP : ' + zone.ip_address)
-                independent = True
-                if speakerSelection == 'party':
-                    print('  group coordinator : ' + \
-                          zone.group.coordinator.player_name)
-                    if zone != zone.group.coordinator:
-                        independent = False
-                if independent:
-                    try:
-                        tranInfo = zone.get_current_transport_info()
-                        state = tranInfo[u'current_transport_state']
-                        print('  state : ' + state)
-                        print('  mode : ' + self.getPlayMode(zone))
-                        print('  volume : ' + str(zone.volume))
-                        info = zone.get_current_track_info()
-                        artist = info[u'artist']
-                        if artist and artist != '':
-                            print('  artist : ' + artist)
-                        title = info[u'title']
-                        if title and title != '':
-                            print('  title : ' + title)
-                        #pprint(tranInfo)
-                        #pprint(info)
-                    except:
-                        print('Error: cannot communicate with the speaker.')
-                        if self.verbose:
-                            traceback.print_exc()
-                else:
-                    try:
-                        print('  volume : ' + str(zone.volume))
-                    except:
-                        print('Error: cannot communicate with the speaker.')
-                        if self.verbose:
-                            traceback.print_exc()
+            self.listSpeakerInfo(zones, speakerSelection == 'party',
+                                 args.timeout, args.json)
             exit(0)
 
         if args.partyModeOff and args.partyModeOn:
@@ -397,24 +2920,28 @@ name of the file.
                 print('Error: speaker must be specified (-s) to turn on'
                       ' party mode.')
                 exit(-2)
-            try:
-                speaker.partymode()
-            except:
-                print('Error: cannot communicate with one of the speaker.')
-                if self.verbose:
-                    traceback.print_exc()
+            uri = 'x-rincon:{0}'.format(speaker.uid)
+            def join(zone):
+                zone.avTransport.SetAVTransportURI([
+                    ('InstanceID', 0),
+                    ('CurrentURI', uri),
+                    ('CurrentURIMetaData', '')
+                ])
+            self.groupCall([zone for zone in zones if zone != speaker], join,
+                           args.timeout, 'Joining the party')
+            self.topologyChanged(zones)
             exit(0)
 
         # party over :-(
         if args.partyModeOff:
-            try:
-                for device in cspeaker.group.members:
-                    if not device == device.group.coordinator:
-                        device.unjoin()
-            except:
-                print('Error: cannot communicate with one of the speaker.')
-                if self.verbose:
-                    traceback.print_exc()
+            def unjoin(device):
+                device.avTransport.BecomeCoordinatorOfStandaloneGroup([
+                    ('InstanceID', 0)
+                ])
+            self.groupCall([device for device in cspeaker.group.members
+                            if device != cspeaker], unjoin, args.timeout,
+                           'Leaving the party')
+            self.topologyChanged(zones)
             exit(0)
 
         # toggle pause/play
@@ -438,17 +2965,59 @@ name of the file.
                     traceback.print_exc()
             exit(0)
 
+        # stop the music
+        if args.pause:
+            if speakerSelection == 'random':
+                print('Error: speaker must be specified (-s) or the speakers'
+                      ' are already in party mode (-P) to pause.')
+                exit(-2)
+            try:
+                state = cspeaker.get_current_transport_info()\
+                        [u'current_transport_state']
+                if state == 'PLAYING':
+                    cspeaker.pause()
+                    print('Speaker now paused.')
+                else:
+                    print('Speaker not playing.')
+            except:
+                print('Error: cannot communicate with the speaker.')
+                if self.verbose:
+                    traceback.print_exc()
+                exit(1)
+            exit(0)
+
         # export some or all the playlists
         if args.exportPlaylist or args.exportAllPlaylists:
-            for pl in cspeaker.get_sonos_playlists():
-                if args.exportAllPlaylists or pl.title in args.exportPlaylist:
-                    self.exportPl(cspeaker, pl, args.force, args.exportDetails)
+            index = self.playlistIndex(cspeaker)
+            pls = [pl for pl in self.indexedPlaylists(index)
+                   if args.exportAllPlaylists or
+                   pl.title in args.exportPlaylist]
+            if args.archive:
+                self.exportArchive(cspeaker, index, pls, args.exportDetails,
+                                   self.exportPath(args.archive), jobs)
+            elif args.incremental:
+                self.exportChangedPls(cspeaker, index, pls,
+                                      args.exportDetails, args.format, jobs)
+            else:
+                self.exportPls(cspeaker, pls, args.force, args.exportDetails,
+                               args.format, jobs)
             exit(0)
 
         # import a playlist from a file
-        if args.importPlaylistFile:
-            for file in args.importPlaylistFile:
-                self.importPl(cspeaker, file)
+        if args.importPlaylistFile or args.resume:
+            if args.importPlaylistFile and args.resume:
+                print('Error: can not import files (-i) and --resume at the'
+                      ' same time.')
+                exit(-2)
+            if not self.importFiles(cspeaker, args.importPlaylistFile,
+                                    args.batchSize, args.sync, args.resume):
+                exit(1)
+            exit(0)
+
+        # import playlists from an archive
+        if args.restore:
+            self.restoreArchive(cspeaker, args.restore, args.restorePlaylist,
+                                args.batchSize, args.sync)
             exit(0)
 
         # set the volume
@@ -462,38 +3031,63 @@ name of the file.
             except ValueError:
                 print('Error: volume is not a number: ' + args.volume)
                 exit(-2)
-            if args.volume.startswith('+') or args.volume.startswith('-'):
-                vol = speaker.volume + vol
-            if vol < 0:
-                print('Warning: volume too low, using 0')
-                vol = 0
-            elif vol > 100:
-                print('Warning: volume too high, using 100')
-                vol = 100
+            relative = args.volume.startswith('+') or \
+                       args.volume.startswith('-')
             try:
-                #if speakerSelection == 'party':
-                #    for member in speaker.group.members:
-                #        member.volume = vol
-                #else:
+                if relative and speakerSelection != 'party':
+                    vol = speaker.volume + vol
+                if not relative or speakerSelection != 'party':
+                    if vol < 0:
+                        print('Warning: volume too low, using 0')
+                        vol = 0
+                    elif vol > 100:
+                        print('Warning: volume too high, using 100')
+                        vol = 100
+                if speakerSelection == 'party':
+                    self.setGroupVolume(cspeaker, vol, relative, args.timeout)
+                else:
                     speaker.volume = vol
             except:
                 print('Error: cannot communicate with the speaker.')
                 if self.verbose:
                     traceback.print_exc()
 
-        # replace the queue with a playlist and start playing
+        # index the music library for queries
+        if args.indexLibrary:
+            self.indexLibrary(cspeaker, jobs)
+            if not args.replaceQueue:
+                exit(0)
+
+        # replace the queue with a playlist, or the tracks of a query, and
+        # start playing
         if args.replaceQueue:
             if speakerSelection == 'random':
                 print('Error: speaker must be specified (-s) or the speakers'
                       ' are already in party mode (-P) when replacing queue.')
                 exit(-2)
-            foundIt = False
-            for pl in cspeaker.get_sonos_playlists():
-                if pl.title == args.replaceQueue:
-                    foundIt = True
-                    self.queue(cspeaker, pl, playMode)
-            if not foundIt:
-                print('Error: playlist for queue not found: ' + args.playlistQ)
+            index = self.playlistIndex(cspeaker)
+            pl = self.findPlaylist(index, args.replaceQueue)
+            try:
+                tracks = None if pl else self.queryLibrary(args.replaceQueue)
+            except ValueError as e:
+                print('Error: ' + str(e))
+                exit(-2)
+            if args.savePlaylist and \
+               self.findPlaylist(index, args.savePlaylist):
+                print('Error: playlist already exists: ' + args.savePlaylist)
+                exit(-2)
+            if pl:
+                self.queue(cspeaker, index, pl, playMode)
+            elif tracks:
+                self.queueTracks(cspeaker, tracks, args.batchSize,
+                                 playMode, args.savePlaylist)
+            elif tracks is not None:
+                print('Error: no tracks match the query: ' +
+                      args.replaceQueue)
+                exit(-2)
+            else:
+                print('Error: playlist for queue not found: ' +
+                      args.replaceQueue)
                 print(' Use -l option to see available playlists.')
                 exit(-2)
 
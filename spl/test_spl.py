@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+""" Tests of spl against mock Sonos speakers. """
+
+from __future__ import print_function
+
+"""
+    Copyright 2015-2016 Jim Stuhlmacher.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, sys, shutil, tempfile, unittest
+try:
+    from io import StringIO
+except ImportError:
+    # Python 2.7
+    from StringIO import StringIO
+
+import spl
+from bench import writeXspf
+from mocksonos import MockHousehold, UPnPError
+
+IP = '127.0.0.2'
+FIELDS = ('uri', 'title', 'creator', 'album')
+
+
+class MockTest(unittest.TestCase):
+    """ Runs spl command lines in process against a mock household with
+        saved playlists, in a temporary directory. """
+
+    def setUp(self):
+        self.household = MockHousehold([IP])
+        for idx in range(2):
+            self.household.addPlaylist('Playlist %d' % (idx + 1), 40,
+                                       idx * 40)
+        self.household.start()
+        self.workDir = tempfile.mkdtemp(prefix='spl-test-')
+        self.oldCwd = os.getcwd()
+        os.chdir(self.workDir)
+        self.oldCacheDir = spl.CACHE_DIR
+        spl.CACHE_DIR = os.path.join(self.workDir, 'cache')
+
+    def tearDown(self):
+        self.household.stop()
+        os.chdir(self.oldCwd)
+        spl.CACHE_DIR = self.oldCacheDir
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def runSpl(self, *argv):
+        """ Run one spl command line on the speaker.  Returns its exit code
+            and output. """
+        output = StringIO()
+        oldStdout = sys.stdout
+        sys.stdout = output
+        code = 0
+        try:
+            spl.SPL(['-s', IP] + list(argv))
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        finally:
+            sys.stdout = oldStdout
+        return code, output.getvalue()
+
+    def playlist(self, title):
+        """ Return the tracks of the saved playlist, or None. """
+        for playlist in self.household.playlists.values():
+            if playlist['title'] == title:
+                return [tuple(track[key] for key in FIELDS)
+                        for track in playlist['tracks']]
+        return None
+
+    def deletePlaylists(self):
+        """ Delete every saved playlist behind spl's back. """
+        with self.household.lock:
+            self.household.playlists.clear()
+            self.household.changed()
+
+
+class TestImportExport(MockTest):
+
+    def testRoundTrip(self):
+        """ Every format exported with -d ACLMT brings back the tracks with
+            their metadata. """
+        expected = self.playlist('Playlist 1')
+        for fmt in sorted(spl.FORMATS):
+            code, output = self.runSpl('-x', 'Playlist 1', '-F', fmt, '-f',
+                                       '-d', 'ACLMT')
+            self.assertEqual(code, 0, output)
+            self.deletePlaylists()
+            code, output = self.runSpl('-i', 'Playlist 1.' + fmt)
+            self.assertEqual(code, 0, output)
+            self.assertEqual(self.playlist('Playlist 1'), expected, fmt)
+
+    def testSync(self):
+        """ --sync edits the playlist into the order of the file. """
+        numbers = list(range(30, 0, -2)) + [200, 201] + list(range(1, 20, 3))
+        with open('sync.m3u', 'w') as fp:
+            fp.write('#EXTM3U\n#PLAYLIST:Playlist 1\n')
+            for number in numbers:
+                fp.write(self.household.track(number)['uri'] + '\n')
+        code, output = self.runSpl('-i', 'sync.m3u', '-y')
+        self.assertEqual(code, 0, output)
+        self.assertEqual([track[0] for track in self.playlist('Playlist 1')],
+                         [self.household.track(number)['uri']
+                          for number in numbers])
+
+    def testResume(self):
+        """ --resume continues a failed import after the tracks in the queue,
+            including a batch added but not confirmed, even with another
+            batch size, and the playlist ends up complete. """
+        writeXspf('resume.xspf', 'Resumed', self.household, 100)
+        household = self.household
+        calls = []
+
+        def failing(speaker, args):
+            # the fourth batch is added but the answer is lost
+            calls.append(args)
+            if len(calls) <= 4:
+                MockHousehold.doAddMultipleURIsToQueue(household, speaker,
+                                                       args)
+            if len(calls) >= 4:
+                raise UPnPError(501)
+        household.doAddMultipleURIsToQueue = failing
+        household.doAddURIToQueue = lambda speaker, args: failing(None, None)
+        code, output = self.runSpl('-i', 'resume.xspf', '-b', '10')
+        self.assertNotEqual(code, 0, output)
+        self.assertIsNone(self.playlist('Resumed'))
+        del household.doAddMultipleURIsToQueue
+        del household.doAddURIToQueue
+
+        household.stats(reset=True)
+        code, output = self.runSpl('--resume', '-b', '4')
+        self.assertEqual(code, 0, output)
+        self.assertNotIn('the queue changed', output)
+        self.assertEqual([track[0] for track in self.playlist('Resumed')],
+                         [household.track(number)['uri']
+                          for number in range(100)])
+        self.assertEqual(household.stats()['AddMultipleURIsToQueue'], 15)
+
+    def testArchiveRestore(self):
+        """ --restore brings back every playlist of the archive. """
+        expected = dict((title, self.playlist(title))
+                        for title in ('Playlist 1', 'Playlist 2'))
+        code, output = self.runSpl('-X', '--archive', 'backup.db',
+                                   '-d', 'ACLMT')
+        self.assertEqual(code, 0, output)
+        self.deletePlaylists()
+        code, output = self.runSpl('--restore', 'backup.db')
+        self.assertEqual(code, 0, output)
+        for title in expected:
+            self.assertEqual(self.playlist(title), expected[title], title)
+
+
+class TestLibrary(MockTest):
+
+    def testQuery(self):
+        """ -q with a query queues the matching tracks of the index, and
+            indexing alone changes nothing on the speaker. """
+        self.household.addLibrary(1000)
+        speaker = self.household.speakers[0]
+        code, output = self.runSpl('--indexLibrary', '-j', '4')
+        self.assertEqual(code, 0, output)
+        self.assertEqual(speaker.playMode, 'NORMAL')
+        code, output = self.runSpl('-q', 'artist:"Artist 3" genre:"Genre 5"',
+                                   '-m', 'srf')
+        self.assertEqual(code, 0, output)
+        expected = [self.household.track(number) for number in range(1000)]
+        expected = sorted([(track['creator'], track['album'], track['title'])
+                           for track in expected
+                           if track['creator'] == 'Artist 3' and
+                           track['genre'] == 'Genre 5'])
+        self.assertTrue(expected)
+        self.assertEqual([(track['creator'], track['album'], track['title'])
+                          for track in speaker.queue], expected)
+        code, output = self.runSpl('-q', "Nope's")
+        self.assertIn('playlist for queue not found', output)
+
+
+if __name__ == '__main__':
+    unittest.main()